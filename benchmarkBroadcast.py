@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+"""Measures the cost of Endpoint.send to all peers (including building the packets)
+against the number of peers. The last column is the cost of copying and encoding
+the message for every peer, which Endpoint.send did before on top of the rest."""
+import copy
+from time import perf_counter
+from transmitter.general import Server
+
+from benchmarkCodec import StateMessage
+
+def broadcast(server, msg, number):
+    t = perf_counter()
+    for i in range(number):
+        server.send(msg)
+        for peer in server.peers.values():
+            for packet in peer.outgoingPackets:
+                pass
+    return perf_counter() - t
+
+def encodePerPeer(server, msg, number):
+    t = perf_counter()
+    for i in range(number):
+        for peer in server.peers.values():
+            copy.deepcopy(msg)._getBytes()
+    return perf_counter() - t
+
+if __name__ == '__main__':
+    
+    server = Server()
+    server.messageFactory.add(StateMessage)
+    server.bind(('127.0.0.1', 0))
+    
+    msg = StateMessage(entity=1, x=1.5, y=2.5, z=3.5)
+    number = 200
+    
+    print('{:>6} {:>16} {:>16} {:>22}'.format('peers', 'us/broadcast', 'us/peer', 'us/peer saved'))
+    for peers in (1, 10, 100, 500, 1000):
+        while len(server.peers) < peers:
+            server._newPeer(('127.0.0.1', 10000 + len(server.peers)))
+        seconds = broadcast(server, msg, number)
+        old = encodePerPeer(server, msg, number)
+        print('{:>6} {:>16.1f} {:>16.2f} {:>22.2f}'.format(peers,
+            seconds / number * 1e6, seconds / number / peers * 1e6, old / number / peers * 1e6))
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+"""Compares encoding/decoding of messages with compiled codecs
+against the per-call format building, which was used before,
+of an array field against packing the floats into a bytes field
+and of a batch of messages (list field) against the messages one by one."""
+import array
+import struct
+from timeit import timeit
+from transmitter.Message import Message, MessageFactory
+from transmitter.ByteBuffer import ByteBuffer
+
+from exampleClient import AMessage
+
+class StateMessage(Message):
+    msgID = 2
+    msgData = {
+        'entity': ('int', 0),
+        'x': ('float', 0),
+        'y': ('float', 0),
+        'z': ('float', 0),
+        'vx': ('float', 0),
+        'vy': ('float', 0),
+        'vz': ('float', 0),
+        'visible': ('bool', True)
+    }
+
+class PositionsMessage(Message):
+    msgID = 3
+    msgData = {
+        'positions': ('array:f4[3]', ())
+    }
+
+class PackedPositionsMessage(Message):
+    msgID = 4
+    msgData = {
+        'positions': ('bytes', b'')
+    }
+
+class BatchMessage(Message):
+    msgID = 5
+    msgData = {
+        'states': ('list:msg:StateMessage', ())
+    }
+
+def legacyGetBytes(msg):
+    format = '!l'
+    values = [msg.msgID]
+    for k, v in msg._items():
+        t = v[0]
+        v = v[1]
+        if t == 'int':      format += 'l'
+        elif t == 'float':  format += 'f'
+        elif t in ('str', 'bytes'):
+            if t == 'str':
+                v = v.encode()
+            format += 'L'
+            values.append(len(v))
+            format += str(len(v)) + 's'
+        elif t == 'bool':   format += '?'
+        values.append(v)
+    return struct.pack(format, *values)
+
+def legacyReadFromByteBuffer(msg, byteBuffer):
+    for k, v in msg._items():
+        t = v[0]
+        if t == 'int':      msg.__setattr__(k, byteBuffer.readStruct('l')[0])
+        elif t == 'float':  msg.__setattr__(k, byteBuffer.readStruct('f')[0])
+        elif t in ('str', 'bytes'):
+            length = byteBuffer.readStruct('L')[0]
+            data = byteBuffer.readStruct(str(length) + 's')[0]
+            if t == 'str':
+                data = data.decode()
+            msg.__setattr__(k, data)
+        elif t == 'bool':   msg.__setattr__(k, byteBuffer.readStruct('?')[0])
+
+def run(name, func, number):
+    seconds = timeit(func, number=number)
+    rate = number / seconds
+    print('{:<40} {:>12.0f} msg/s'.format(name, rate))
+    return rate
+
+if __name__ == '__main__':
+    
+    factory = MessageFactory()
+    factory.add(AMessage, StateMessage, BatchMessage)
+    
+    number = 100000
+    
+    for Msg in (AMessage, StateMessage):
+        msg = Msg()
+        data = msg._getBytes()
+        assert data == legacyGetBytes(msg)
+        
+        def decode():
+            byteBuffer = ByteBuffer(data)
+            byteBuffer.readStruct('l')
+            Msg()._readFromByteBuffer(byteBuffer)
+        
+        def legacyDecode():
+            byteBuffer = ByteBuffer(data)
+            byteBuffer.readStruct('l')
+            legacyReadFromByteBuffer(Msg(), byteBuffer)
+        
+        print(Msg.__name__)
+        old = run('  encode (legacy)', lambda: legacyGetBytes(msg), number)
+        new = run('  encode (codec)', msg._getBytes, number)
+        print('  speedup: {:.1f}x'.format(new / old))
+        old = run('  decode (legacy)', legacyDecode, number)
+        new = run('  decode (codec)', decode, number)
+        print('  speedup: {:.1f}x'.format(new / old))
+    
+    positions = array.array('f', range(30000))
+    print('10k positions')
+    msg = PositionsMessage(positions=positions)
+    data = msg._getBytes()
+    
+    def packed():
+        return PackedPositionsMessage(positions=struct.pack('!{}f'.format(len(positions)), *positions))._getBytes()
+    
+    def decode():
+        byteBuffer = ByteBuffer(data)
+        byteBuffer.readStruct('l')
+        PositionsMessage()._readFromByteBuffer(byteBuffer)
+    
+    packedData = packed()
+    
+    def unpack():
+        byteBuffer = ByteBuffer(packedData)
+        byteBuffer.readStruct('l')
+        msg = PackedPositionsMessage()
+        msg._readFromByteBuffer(byteBuffer)
+        struct.unpack('!{}f'.format(len(msg.positions) // 4), msg.positions)
+    
+    number = 1000
+    old = run('  encode (packed bytes)', packed, number)
+    new = run('  encode (array)', msg._getBytes, number)
+    print('  speedup: {:.1f}x'.format(new / old))
+    old = run('  decode (packed bytes)', unpack, number)
+    new = run('  decode (array)', decode, number)
+    print('  speedup: {:.1f}x'.format(new / old))
+    
+    states = [StateMessage(entity=i, x=i) for i in range(200)]
+    print('200 states')
+    msg = BatchMessage(states=states)
+    data = msg._getBytes()
+    singles = [state._getBytes() for state in states]
+    
+    def encodeSingles():
+        for state in states:
+            state._getBytes()
+    
+    def decode():
+        byteBuffer = ByteBuffer(data)
+        byteBuffer.readStruct('l')
+        BatchMessage()._readFromByteBuffer(byteBuffer)
+    
+    def decodeSingles():
+        for data in singles:
+            byteBuffer = ByteBuffer(data)
+            byteBuffer.readStruct('l')
+            StateMessage()._readFromByteBuffer(byteBuffer)
+    
+    number = 1000
+    old = run('  encode (messages)', encodeSingles, number)
+    new = run('  encode (batch)', msg._getBytes, number)
+    print('  speedup: {:.1f}x'.format(new / old))
+    old = run('  decode (messages)', decodeSingles, number)
+    new = run('  decode (batch)', decode, number)
+    print('  speedup: {:.1f}x'.format(new / old))
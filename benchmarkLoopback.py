@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+"""Measures a Server (in its own process) and clients on localhost:
+messages/s, bytes/s, CPU time per message of both processes and the
+one-way and round trip latency (p50/p99/p999) of small unreliable,
+small reliable and split messages (echoed by the server, at most window
+messages per client in flight) and of broadcasts to all clients.
+With --json the results are written as JSON, --compare prints the change
+against such a file, e.g. of the last commit.
+The one-way latency compares the clocks of both processes, so it needs one host."""
+import os
+import json
+import select
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from time import time, process_time, strftime
+from transmitter.general import Server, Client
+from transmitter.Message import Message
+
+class Payload(Message):
+    msgID = 10
+    msgData = {
+        'number': ('int', 0),
+        'sent': ('double', 0),
+        'data': ('bytes', b'')
+    }
+
+class Echo(Message):
+    msgID = 11
+    msgData = {
+        'number': ('int', 0),
+        'sent': ('double', 0),
+        'received': ('double', 0)
+    }
+
+SCENARIOS = {
+    'unreliable': {'reliable': False, 'size': 16},
+    'reliable': {'reliable': True, 'size': 16},
+    'split': {'reliable': True, 'size': 20000},
+    'broadcast': {'reliable': False, 'size': 16, 'broadcast': True},
+}
+# unreliable messages, which are not echoed within this many seconds, are lost
+LOSS_TIMEOUT = 1
+
+def percentiles(samples):
+    """Returns p50, p99 and p999 of samples (seconds) in milliseconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {'p50': None, 'p99': None, 'p999': None}
+    return {name: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3)
+        for name, q in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999))}
+
+def serve(conn, addr):
+    """The server process: echoes the Payloads or broadcasts them, as conn says"""
+    server = Server()
+    server.messageFactory.add(Payload, Echo)
+    server.bind(addr)
+    server.start()
+    scenario = {'reliable': False}
+    received = [0]
+    
+    def onMessage(msg, peer):
+        if msg == 'Payload':
+            received[0] += 1
+            peer.send(Echo(number=msg.number, sent=msg.sent, received=time()), reliable=scenario['reliable'])
+    server.onMessage.attach(onMessage)
+    conn.send(server._socket.getsockname())
+    
+    while True:
+        if conn.poll():
+            command = conn.recv()
+            if command == 'quit':
+                break
+            if command == 'go':
+                scenario = conn.recv()
+                received[0] = 0
+                bytesIn, bytesOut = server.bytesIn.total, server.bytesOut.total
+                broadcasts = 0
+                data = bytes(scenario['size'])
+                cpu = process_time()
+                start = time()
+            elif command == 'stop':
+                conn.send({
+                    'cpu': process_time() - cpu,
+                    'received': received[0],
+                    'broadcasts': broadcasts,
+                    'bytesIn': server.bytesIn.total - bytesIn,
+                    'bytesOut': server.bytesOut.total - bytesOut,
+                })
+                scenario = {'reliable': False}
+        if scenario.get('broadcast'):
+            due = int((time() - start) * scenario['rate'])
+            while broadcasts < due:
+                server.send(Payload(number=broadcasts, sent=time(), data=data))
+                broadcasts += 1
+            server.update(timeout=0.0005)
+        else:
+            server.update(timeout=0.001)
+    server.disconnect()
+    for i in range(10):
+        server.update(timeout=0.01)
+
+def pump(clients, timeout=0.001):
+    """Updates the clients, after waiting at most timeout seconds for one of them"""
+    clients = [client for client in clients if not client.closed]
+    select.select(clients, [], [], timeout)
+    for client in clients:
+        client.update()
+
+def runEcho(conn, clients, scenario, duration, window):
+    """Every client sends Payloads, keeping at most window of them not echoed"""
+    reliable = scenario['reliable']
+    data = bytes(scenario['size'])
+    outstanding = [{} for client in clients]
+    oneWay = []
+    roundTrip = []
+    lost = [0]
+    
+    for i, client in enumerate(clients):
+        def onMessage(msg, peer, outstanding=outstanding[i]):
+            if msg == 'Echo' and outstanding.pop(msg.number, None) is not None:
+                now = time()
+                oneWay.append(msg.received - msg.sent)
+                roundTrip.append(now - msg.sent)
+        # replaces the handler of the previous scenario
+        client.onMessage.handlers[:] = [onMessage]
+    
+    conn.send('go')
+    conn.send(scenario)
+    number = 0
+    cpu = process_time()
+    start = time()
+    while time() - start < duration:
+        now = time()
+        for client, pending in zip(clients, outstanding):
+            if not reliable:
+                for n in [n for n, sent in pending.items() if now - sent > LOSS_TIMEOUT]:
+                    del pending[n]
+                    lost[0] += 1
+            while len(pending) < window:
+                number += 1
+                pending[number] = now
+                client.send(Payload(number=number, sent=now, data=data), reliable=reliable)
+        pump(clients)
+    # the messages in flight
+    drain = time()
+    while any(outstanding) and time() - drain < LOSS_TIMEOUT * 2:
+        pump(clients)
+    elapsed = time() - start
+    cpu = process_time() - cpu
+    lost[0] += sum(len(pending) for pending in outstanding)
+    conn.send('stop')
+    server = conn.recv()
+    return {
+        'messages': server['received'],
+        'messagesPerSecond': round(server['received'] / elapsed),
+        'bytesPerSecond': round(server['bytesIn'] / elapsed),
+        'serverCpuPerMessage': round(server['cpu'] / max(1, server['received']) * 1e6, 2),
+        'clientCpuPerMessage': round(cpu / max(1, len(roundTrip)) * 1e6, 2),
+        'lost': lost[0],
+        'oneWay': percentiles(oneWay),
+        'roundTrip': percentiles(roundTrip),
+    }
+
+def runBroadcast(conn, clients, scenario, duration, rate):
+    """The server broadcasts rate Payloads per second to all clients"""
+    oneWay = []
+    
+    def onMessage(msg, peer):
+        if msg == 'Payload':
+            oneWay.append(time() - msg.sent)
+    for client in clients:
+        client.onMessage.handlers[:] = [onMessage]
+    
+    scenario = dict(scenario, rate=rate)
+    conn.send('go')
+    conn.send(scenario)
+    cpu = process_time()
+    start = time()
+    while time() - start < duration:
+        pump(clients)
+    conn.send('stop')
+    server = conn.recv()
+    # the messages in flight
+    drain = time()
+    while len(oneWay) < server['broadcasts'] * len(clients) and time() - drain < LOSS_TIMEOUT:
+        pump(clients)
+    elapsed = time() - start
+    cpu = process_time() - cpu
+    deliveries = server['broadcasts'] * len(clients)
+    return {
+        'messages': len(oneWay),
+        'messagesPerSecond': round(len(oneWay) / elapsed),
+        'bytesPerSecond': round(server['bytesOut'] / elapsed),
+        'serverCpuPerMessage': round(server['cpu'] / max(1, deliveries) * 1e6, 2),
+        'serverCpuPerBroadcast': round(server['cpu'] / max(1, server['broadcasts']) * 1e6, 2),
+        'clientCpuPerMessage': round(cpu / max(1, len(oneWay)) * 1e6, 2),
+        'lost': deliveries - len(oneWay),
+        'oneWay': percentiles(oneWay),
+        'roundTrip': percentiles(()),
+    }
+
+def commit():
+    """Returns the commit of the checkout this file belongs to, wherever it is run from"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def printResults(results):
+    print('{:<12} {:>10} {:>10} {:>10} {:>10} {:>24} {:>24}'.format('', 'msg/s', 'MB/s',
+        'us/msg srv', 'us/msg cl', 'one-way p50/p99/p999 ms', 'rtt p50/p99/p999 ms'))
+    for name, result in results.items():
+        latencies = ['/'.join('-' if v is None else '{:.2f}'.format(v) for v in result[key].values())
+            for key in ('oneWay', 'roundTrip')]
+        print('{:<12} {:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>24} {:>24}'.format(name,
+            result['messagesPerSecond'], result['bytesPerSecond'] / 1e6, result['serverCpuPerMessage'],
+            result['clientCpuPerMessage'], *latencies))
+
+def printComparison(results, config, old):
+    """Prints the metrics of results relative to the ones of old (a file written with --json)"""
+    print('compared to {} ({}){}'.format(old.get('commit'), old.get('date'),
+        '' if old.get('config') == config else ', with a different config: {}'.format(old.get('config'))))
+    for name, result in results.items():
+        before = old['results'].get(name)
+        if before is None:
+            continue
+        changes = []
+        for key in ('messagesPerSecond', 'serverCpuPerMessage', 'clientCpuPerMessage'):
+            if before.get(key):
+                changes.append('{} {:+.1f}%'.format(key, (result[key] / before[key] - 1) * 100))
+        for key in ('oneWay', 'roundTrip'):
+            if before[key]['p99'] and result[key]['p99'] is not None:
+                changes.append('{} p99 {:+.1f}%'.format(key, (result[key]['p99'] / before[key]['p99'] - 1) * 100))
+        print('{:<12} {}'.format(name, ', '.join(changes)))
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run: {} (default: all)'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=3, help='seconds per scenario')
+    parser.add_argument('--window', type=int, default=32, help='messages in flight per client')
+    parser.add_argument('--rate', type=int, default=2000, help='broadcasts per second')
+    parser.add_argument('--protocol', type=int, help='protocol the clients request')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results written with --json before')
+    args = parser.parse_args()
+    scenarios = args.scenarios or list(SCENARIOS)
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error('unknown scenario {}'.format(name))
+    
+    conn, serverConn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(serverConn, ('127.0.0.1', 0)), daemon=True)
+    process.start()
+    addr = conn.recv()
+    
+    clients = []
+    for i in range(args.clients):
+        client = Client()
+        client.messageFactory.add(Payload, Echo)
+        if args.protocol is not None:
+            client.protocol = args.protocol
+        client.connect(addr)
+        client.start()
+        clients.append(client)
+    while any(client.state != client.CONNECTED for client in clients):
+        pump(clients, 0.01)
+    
+    results = {}
+    for name in scenarios:
+        scenario = SCENARIOS[name]
+        if scenario.get('broadcast'):
+            results[name] = runBroadcast(conn, clients, scenario, args.duration, args.rate)
+        else:
+            results[name] = runEcho(conn, clients, scenario, args.duration, args.window)
+    
+    for client in clients:
+        client.disconnect()
+    conn.send('quit')
+    for i in range(10):
+        pump(clients, 0.01)
+    process.join(5)
+    
+    printResults(results)
+    report = {
+        'commit': commit(),
+        'date': strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'clients': args.clients, 'duration': args.duration, 'window': args.window,
+            'rate': args.rate, 'protocol': clients[0].protocol},
+        'results': results,
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            printComparison(results, report['config'], json.load(f))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
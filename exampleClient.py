@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-from time import sleep, time
+from time import time
 from transmitter.general import Client
 from transmitter.Message import Message
 
@@ -53,8 +53,7 @@ if __name__ == '__main__':
     
     try:
         while True:
-            sleep(0.01)
-            client.update()
+            client.update(timeout=0.5)
             _print('Latency:', client.latency)
     except KeyboardInterrupt:
         client.disconnect()
@@ -1,5 +1,4 @@
 #!/usr/bin/python3
-from time import sleep
 from transmitter.general import Server
 
 from exampleClient import AMessage
@@ -33,8 +32,8 @@ if __name__ == '__main__':
     
     try:
         while True:
-            sleep(0.01)
-            server.update()
+            # blocks until there is something to do
+            server.update(timeout=1)
     except KeyboardInterrupt:
         server.disconnect()
         server.update()
@@ -0,0 +1,55 @@
+import unittest
+from time import time
+from transmitter.general import Server, Client
+from transmitter.Message import Message
+from transmitter.Scheduler import NORMAL, LOW
+
+class Data(Message):
+    msgID = 1
+    msgReliable = True
+    msgData = {
+        'number': ('int', 0),
+        'data': ('bytes', b'')
+    }
+
+def pump(endpoints, until, timeout=5):
+    deadline = time() + timeout
+    while not until() and time() < deadline:
+        for endpoint in endpoints:
+            endpoint.update(timeout=0.005)
+
+class TestCongestionWindow(unittest.TestCase):
+    def test_retransmit_lower_priority(self):
+        """Messages waiting for the window do not hold back the retransmissions
+        of lower priorities, which are what frees it"""
+        server = Server()
+        client = Client()
+        client.congestionControl = True
+        for endpoint in (server, client):
+            endpoint.messageFactory.add(Data)
+        received = []
+        server.onMessage.attach(lambda msg, peer: received.append(msg.number))
+        server.bind(('127.0.0.1', 0))
+        server.start()
+        client.connect(server._socket.getsockname())
+        client.start()
+        self.addCleanup(client._close)
+        self.addCleanup(server._close)
+        pump((client, server), lambda: client.state == client.CONNECTED)
+        self.assertEqual(client.state, client.CONNECTED)
+        
+        send = client._send
+        client._send = lambda data, addr: None
+        data = bytes(1000)
+        for i in range(20):
+            client.send(Data(number=i, data=data), priority=LOW)
+        pump((client,), lambda: False, timeout=0.2)
+        client.send(Data(number=20, data=data), priority=NORMAL)
+        pump((client,), lambda: False, timeout=0.2)
+        client._send = send
+        
+        pump((client, server), lambda: len(received) == 21, timeout=8)
+        self.assertEqual(sorted(received), list(range(21)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from time import time
+from transmitter.general import Server, Client
+from transmitter.Message import Message
+
+class Snapshot(Message):
+    msgID = 1
+    msgDelta = True
+    msgDeltaKey = 'entity'
+    msgData = {
+        'entity': ('int', 0),
+        'x': ('float', 0),
+        'blob': ('bytes', b'')
+    }
+
+def pump(endpoints, until, timeout=5):
+    deadline = time() + timeout
+    while not until() and time() < deadline:
+        for endpoint in endpoints:
+            endpoint.update(timeout=0.005)
+
+class TestDeltaNearMTU(unittest.TestCase):
+    def connect(self, protocol):
+        server = Server()
+        client = Client()
+        client.protocol = protocol
+        for endpoint in (server, client):
+            endpoint.messageFactory.add(Snapshot)
+        server.bind(('127.0.0.1', 0))
+        server.start()
+        client.connect(server._socket.getsockname())
+        client.start()
+        pump((client, server), lambda: client.state == client.CONNECTED)
+        self.addCleanup(client._close)
+        self.addCleanup(server._close)
+        self.assertEqual(client.state, client.CONNECTED)
+        return server, client
+    
+    def check(self, protocol):
+        """A snapshot, which fits the MTU only without the delta header, is sent as it is"""
+        server, client = self.connect(protocol)
+        peer = list(server.peers.values())[0]
+        received = []
+        client.onMessage.attach(lambda msg, peer: received.append(msg))
+        
+        if peer.compact:
+            size = lambda msg: 2 + len(msg._getBytes(True))
+        else:
+            size = lambda msg: 9 + len(msg._bytes)
+        msg = Snapshot(entity=1, x=0)
+        while size(msg) != peer.maxMessageSize:
+            # the varint length of blob grows with it
+            msg.blob = bytes(len(msg.blob) + peer.maxMessageSize - size(msg))
+        self.assertEqual(size(msg), peer.maxMessageSize)
+        for i in range(3):
+            msg.x = i
+            server.send(msg)
+            pump((server, client), lambda: len(received) > i)
+        self.assertEqual([(m.entity, m.x, len(m.blob)) for m in received], [(1, i, len(msg.blob)) for i in range(3)])
+        self.assertEqual(peer.deltaEncoder.full + peer.deltaEncoder.deltas, 0)
+        self.assertEqual(peer.deltaEncoder._pending, {})
+        self.assertFalse(peer.streams)
+        
+        # smaller snapshots are still delta encoded
+        msg.blob = b'small'
+        for i in range(3):
+            msg.x = 10 + i
+            server.send(msg)
+            pump((server, client), lambda: len(received) > 3 + i)
+        self.assertEqual([m.x for m in received[3:]], [10, 11, 12])
+        self.assertEqual(peer.deltaEncoder.full + peer.deltaEncoder.deltas, 3)
+    
+    def test_plain(self):
+        self.check(5)
+    
+    def test_compact(self):
+        self.check(8)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+import asyncio
+from collections import deque
+from time import time
+from transmitter.Endpoint import Endpoint
+
+import logging
+logger = logging.getLogger(__name__)
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+    
+    def datagram_received(self, data, addr):
+        self.endpoint._datagramReceived(data, addr)
+    
+    def error_received(self, exc):
+        logger.warning('Socket error: %s', exc)
+    
+    def pause_writing(self):
+        self.endpoint._writable.clear()
+    
+    def resume_writing(self):
+        self.endpoint._writable.set()
+
+class _LoopNotifier(object):
+    """Stands in for the Notifier, the loop is woken up by _wakeUp instead of a socketpair"""
+    def set(self):
+        pass
+    
+    def clear(self):
+        pass
+
+class AsyncEndpoint(Endpoint):
+    """An Endpoint running on an asyncio event loop instead of a receiving thread.
+    Incoming messages are received by async iteration:
+        async for msg, peer in endpoint: ...
+    onConnect, onDisconnect and onTimeout are fired like by update().
+    There is no need to call update(), retransmissions and pings are
+    scheduled on the loop."""
+    _Notifier = _LoopNotifier
+    
+    def __init__(self):
+        super().__init__()
+        self._loop = None
+        self._transport = None
+        self._tickHandle = None
+        self._timerHandle = None
+        self._writable = asyncio.Event()
+        self._writable.set()
+        # (msg, peer)
+        self._incoming = deque()
+        self._incomingWaiter = None
+        self._connectWaiter = None
+    
+    async def bind(self, addr):
+        super().bind(addr)
+        await self._open()
+    
+    async def connect(self, addr):
+        """Returns when the server accepted the connection
+        Raises ConnectionError, if it rejected it or did not answer"""
+        super().connect(addr)
+        await self._open()
+        self._connectWaiter = self._loop.create_future()
+        self._tick()
+        await self._connectWaiter
+        if self.state != self.CONNECTED:
+            raise ConnectionError('Could not connect to {}'.format(addr))
+    
+    def start(self):
+        raise RuntimeError('AsyncEndpoints receive on the event loop - await bind or connect')
+    
+    def wait(self, timeout=None):
+        raise RuntimeError('AsyncEndpoints are updated by the event loop - async iterate over them')
+    
+    def fileno(self):
+        raise RuntimeError('AsyncEndpoints are updated by the event loop - async iterate over them')
+    
+    async def _open(self):
+        self._loop = asyncio.get_running_loop()
+        self._socket.setblocking(False)
+        self._transport, _ = await self._loop.create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), sock=self._socket)
+    
+    def disconnect(self):
+        super().disconnect()
+        self._wakeUp()
+    
+    async def send(self, msg, exclude=[], **flags):
+        """Queues msg for all peers and waits until the socket accepts more data"""
+        super().send(msg, exclude, **flags)
+        self._wakeUp()
+        await self._writable.wait()
+    
+    def _send(self, data, addr):
+        self._transport.sendto(data, addr)
+        self.bytesOut += len(data)
+        self.packetsOut += 1
+    
+    def _datagramReceived(self, data, addr):
+        self.bytesIn += len(data)
+        self.packetsIn += 1
+        peer = self.getPeerByAddr(addr)
+        if not peer:
+            if not self.accepting:
+                return
+            peer = self._newPeer(addr)
+        self._processData(data, peer)
+        self._wakeUp()
+    
+    def _handleMessage(self, msg, peer):
+        if msg.msgID >= 0:
+            self._incoming.append((msg, peer))
+            if self._incomingWaiter and not self._incomingWaiter.done():
+                self._incomingWaiter.set_result(None)
+        else:
+            super()._handleMessage(msg, peer)
+    
+    def _wakeUp(self):
+        # everything, which happens until the loop gets control again, is handled at once
+        if self._loop and self._tickHandle is None and not self.closed:
+            self._tickHandle = self._loop.call_soon(self._tick)
+    
+    def _tick(self):
+        self._tickHandle = None
+        if self.closed:
+            return
+        self.update()
+        if self._connectWaiter and not self._connectWaiter.done() and self.state != self.CONNECTING:
+            self._connectWaiter.set_result(None)
+        if self._timerHandle:
+            self._timerHandle.cancel()
+            self._timerHandle = None
+        deadline = self.nextDeadline()
+        if deadline is not None and not self.closed:
+            self._timerHandle = self._loop.call_later(max(0, deadline - time()), self._wakeUp)
+    
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._transport.close()
+        if self._timerHandle:
+            self._timerHandle.cancel()
+        if self._incomingWaiter and not self._incomingWaiter.done():
+            self._incomingWaiter.set_result(None)
+    
+    def __aiter__(self):
+        return self
+    
+    async def __anext__(self):
+        while not self._incoming:
+            if self.closed:
+                raise StopAsyncIteration
+            self._incomingWaiter = self._loop.create_future()
+            await self._incomingWaiter
+        return self._incoming.popleft()
@@ -1,28 +1,97 @@
 import struct
 
+# single byte varints
+_smallVarints = [bytes((i,)) for i in range(0x80)]
+
+def encodeVarint(value):
+    """Returns value (>= 0) in 7 bit groups, least significant first,
+    the high bit of every byte but the last is set"""
+    if value < 0x80:
+        if value < 0:
+            raise ValueError('varint must not be negative: {}'.format(value))
+        return _smallVarints[value]
+    result = bytearray()
+    while value >= 0x80:
+        result.append(value & 0x7f | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def zigzag(value):
+    """Maps signed to unsigned integers, so small negative numbers get small varints"""
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
 class ByteBuffer(object):
+    """Reads data with a cursor over a memoryview, so reading does not copy
+    the remaining data. Only read() copies the requested bytes."""
+    
+    # precompiled structs for readStruct
+    _structs = {}
+    
     def __init__(self, data=b''):
-        self.data = data
+        self.data = memoryview(data)
+        self.offset = 0
     
     def __len__(self):
-        return len(self.data)
+        return len(self.data) - self.offset
     
     def append(self, data):
-        self.data += data
+        self.data = memoryview(bytes(self.data[self.offset:]) + data)
+        self.offset = 0
     
     def contains(self, data):
-        return data in self.data
+        return data in self.data[self.offset:].tobytes()
     
-    def read(self, num, peek=False):
-        if num > len(self.data):
+    def readView(self, num, peek=False):
+        """Like read, but returns a memoryview into the buffer instead of a copy"""
+        if num > len(self):
             return False
-        result = self.data[:num]
+        end = self.offset + num
+        result = self.data[self.offset:end]
         if not peek:
-            self.data = self.data[num:]
+            self.offset = end
         return result
     
+    def read(self, num, peek=False):
+        result = self.readView(num, peek)
+        if result is False:
+            return False
+        return result.tobytes()
+    
     def readStruct(self, format, peek=False):
-        format = '!' + format
-        size = struct.calcsize(format)
-        data = self.read(size, peek)
-        return struct.unpack(format, data)
+        try:
+            compiled = self._structs[format]
+        except KeyError:
+            compiled = self._structs[format] = struct.Struct('!' + format)
+        return self.unpack(compiled, peek)
+    
+    def unpack(self, compiled, peek=False):
+        """Like readStruct, but takes a precompiled struct.Struct"""
+        result = compiled.unpack_from(self.data, self.offset)
+        if not peek:
+            self.offset += compiled.size
+        return result
+    
+    def readByte(self):
+        """Like readStruct('B')[0], without the tuple"""
+        byte = self.data[self.offset]
+        self.offset += 1
+        return byte
+    
+    def readVarint(self):
+        data = self.data
+        offset = self.offset
+        result = 0
+        shift = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        self.offset = offset
+        return result
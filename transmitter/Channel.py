@@ -0,0 +1,111 @@
+import logging
+logger = logging.getLogger(__name__)
+
+# messages of a channel are sent with the channel number, or'ed with SEQUENCED for unreliable messages,
+# so the reliable and the unreliable messages of a channel are ordered independently
+SEQUENCED = 0x80
+CHANNELS = 0x80
+
+class _Pending(object):
+    """The place of a split message in an OrderedChannel, until it is reassembled
+    (or skipped, because the Reassembler dropped or evicted it)"""
+    def __init__(self):
+        self.skipped = False
+
+class OrderedChannel(object):
+    """Delivers the reliable messages of a channel in the order they were sent.
+    Messages, which arrive before earlier ones, wait in a reorder buffer of at most window
+    messages. Later ones are refused (not acknowledged), so they are sent again,
+    but split messages (their memory is limited by the Reassembler).
+    Split messages, which the Reassembler drops or evicts, are skipped."""
+    def __init__(self, window):
+        self.window = window
+        # channel sequence number of the next message to deliver
+        self.next = 1
+        self.buffer = {}
+        # statistics
+        self.reordered = 0
+        self.refused = 0
+        self.skipped = 0
+    
+    def accepts(self, sequence):
+        if sequence < self.next + self.window:
+            return True
+        self.refused += 1
+        return False
+    
+    def receive(self, sequence, msg):
+        """Returns the messages, which can be delivered now (in order)"""
+        if sequence < self.next or sequence in self.buffer:
+            # delivered or waiting already
+            return ()
+        self.buffer[sequence] = msg
+        if sequence != self.next:
+            self.reordered += 1
+        return self._release()
+    
+    def pending(self, sequence):
+        """Keeps the place of a split message, which is delivered with complete"""
+        return self.receive(sequence, _Pending())
+    
+    def complete(self, sequence, msg):
+        if not isinstance(self.buffer.get(sequence), _Pending):
+            return ()
+        self.buffer[sequence] = msg
+        return self._release()
+    
+    def skip(self, sequence):
+        """Gives up the place of a split message, which will not be reassembled"""
+        pending = self.buffer.get(sequence)
+        if not isinstance(pending, _Pending):
+            return ()
+        pending.skipped = True
+        return self._release()
+    
+    def _release(self):
+        messages = []
+        buffer = self.buffer
+        while self.next in buffer:
+            msg = buffer[self.next]
+            if isinstance(msg, _Pending):
+                if not msg.skipped:
+                    break
+                logger.warning('Skipping split message %s of channel, it was not reassembled', self.next)
+                self.skipped += 1
+            else:
+                messages.append(msg)
+            del buffer[self.next]
+            self.next += 1
+        return messages
+    
+    def __repr__(self):
+        return '<OrderedChannel next={} buffered={}>'.format(self.next, len(self.buffer))
+
+class SequencedChannel(object):
+    """Delivers the unreliable messages of a channel, which are newer than
+    the last one delivered, older ones are stale and discarded"""
+    def __init__(self):
+        self.last = 0
+        self.stale = 0
+    
+    def accepts(self, sequence):
+        return True
+    
+    def receive(self, sequence, msg):
+        if sequence <= self.last:
+            self.stale += 1
+            return ()
+        self.last = sequence
+        return (msg,)
+    
+    def pending(self, sequence):
+        return ()
+    
+    def skip(self, sequence):
+        return ()
+    
+    # a split message is delivered, if it is still the newest when it is reassembled
+    complete = receive
+    
+    def __repr__(self):
+        return '<SequencedChannel last={} stale={}>'.format(self.last, self.stale)
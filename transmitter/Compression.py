@@ -0,0 +1,102 @@
+import zlib
+import hashlib
+from time import thread_time
+from transmitter.Message import TransportMessage
+
+import logging
+logger = logging.getLogger(__name__)
+
+ALGORITHM = 'zlib'
+
+def presetDictionary(messageFactory):
+    """Returns a zlib preset dictionary built from the registered messages:
+    the encoded defaults of every message, so both sides build the same one,
+    if they registered the same messages"""
+    classes = sorted(messageFactory.messagesByID.values(), key=lambda clas: clas.msgID)
+    # zlib uses the last 32 KiB, the most useful data belongs to the end
+    return b''.join(clas()._bytes for clas in classes)[-32768:]
+
+def dictionaryID(dictionary):
+    return hashlib.sha1(dictionary).digest()[:8]
+
+class Compression(object):
+    """Compresses the packets and split payloads sent to a peer and decompresses
+    the ones received from it (zlib, negotiated with TCompression when connecting).
+    Compressed data is sent as TCompressed message, only if it is smaller.
+    ratio and the times (CPU seconds) tell whether it pays off."""
+    def __init__(self, messageFactory, level=6, dictionary=None):
+        self.level = level
+        # preset dictionary, used for sending and when the received data says so
+        self.dictionary = dictionary
+        # False while received data is decompressed, but sent data is not compressed yet
+        self.sending = True
+        self._Msg = messageFactory.getByName('TCompressed')
+        self._header = TransportMessage.header.pack(0, 0)
+        # statistics
+        self.rawBytes = 0
+        self.compressedBytes = 0
+        self.compressed = 0
+        self.skipped = 0
+        self.compressTime = 0
+        self.decompressedBytes = 0
+        self.decompressTime = 0
+    
+    def _compress(self, data):
+        t = thread_time()
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        result = compressor.compress(data) + compressor.flush()
+        self.compressTime += thread_time() - t
+        return result
+    
+    def payload(self, data):
+        """Returns the encoded TCompressed message of data, or data if it is not smaller"""
+        msg = self._Msg(data=self._compress(data), dictionary=bool(self.dictionary))._bytes
+        return self._account(data, msg)
+    
+    def packet(self, data):
+        """Returns a packet with a TCompressed message of the packet data, or data if it is not smaller"""
+        packet = self._header + self._Msg(data=self._compress(data), dictionary=bool(self.dictionary))._bytes
+        return self._account(data, packet)
+    
+    def _account(self, data, compressed):
+        self.rawBytes += len(data)
+        if len(compressed) < len(data):
+            self.compressedBytes += len(compressed)
+            self.compressed += 1
+            return compressed
+        self.compressedBytes += len(data)
+        self.skipped += 1
+        return data
+    
+    def decompress(self, msg, limit):
+        """Returns the data of a received TCompressed message,
+        raises ValueError if it is invalid or larger than limit bytes"""
+        t = thread_time()
+        try:
+            if not msg.dictionary:
+                decompressor = zlib.decompressobj()
+            elif self.dictionary:
+                decompressor = zlib.decompressobj(zdict=self.dictionary)
+            else:
+                raise ValueError('compressed with a preset dictionary, which was not negotiated')
+            data = decompressor.decompress(msg.data, limit)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('compressed data is incomplete or larger than {} bytes'.format(limit))
+        except zlib.error as e:
+            raise ValueError(str(e))
+        finally:
+            self.decompressTime += thread_time() - t
+        self.decompressedBytes += len(data)
+        return data
+    
+    @property
+    def ratio(self):
+        """Bytes sent per byte, which was given to compress"""
+        return self.compressedBytes / self.rawBytes if self.rawBytes else 1
+    
+    def __repr__(self):
+        return '<Compression ratio={:.2f} dictionary={} compressTime={:.3f}>'.format(
+            self.ratio, bool(self.dictionary), self.compressTime)
@@ -0,0 +1,83 @@
+class CongestionControl(object):
+    """Limits what a peer sends: a congestion window limits the bytes of reliable
+    messages in flight (unacknowledged), it grows with acknowledgements and is halved
+    on loss (AIMD, with slow start), and an optional token bucket paces all sent
+    bytes to rate bytes per second across updates."""
+    def __init__(self, mtu, rate=None, burst=None, window=None, minWindow=None, maxWindow=2**20):
+        self.mtu = mtu
+        self.minWindow = minWindow or 2 * mtu
+        self.maxWindow = maxWindow
+        # congestion window in bytes
+        self.window = window or 10 * mtu
+        self.slowStartThreshold = maxWindow
+        self.inFlight = 0
+        self.lastDecrease = 0
+        # pacing, bytes per second (None: unlimited)
+        self.rate = rate
+        self.burst = max(burst or 10 * mtu, mtu)
+        self.tokens = self.burst
+        self.lastRefill = 0
+        # the last message held back waits for the window (not for the token bucket)
+        self.windowFull = False
+        # statistics
+        self.blockedSince = None
+        self.pacingDelay = 0
+        self.pacedMessages = 0
+        self.losses = 0
+    
+    def _refill(self, t):
+        if self.lastRefill:
+            self.tokens = min(self.burst, self.tokens + (t - self.lastRefill) * self.rate)
+        self.lastRefill = t
+    
+    def allow(self, size, t, new=False):
+        """Returns True, if a message of size bytes can be sent now and accounts for it
+        new: a reliable message, which is not in flight yet"""
+        self.windowFull = bool(new and self.inFlight and self.inFlight + size > self.window)
+        if self.windowFull:
+            self._block(t)
+            return False
+        if self.rate:
+            self._refill(t)
+            if self.tokens < size:
+                self._block(t)
+                return False
+            self.tokens -= size
+        if new:
+            self.inFlight += size
+        if self.blockedSince is not None:
+            self.pacingDelay += t - self.blockedSince
+            self.pacedMessages += 1
+            self.blockedSince = None
+        return True
+    
+    def _block(self, t):
+        if self.blockedSince is None:
+            self.blockedSince = t
+    
+    def nextSendTime(self, size):
+        """Returns the time, when the token bucket allows to send size bytes,
+        None if it does not hold them back (a message waiting for the window
+        is sent when an acknowledgement or a retransmission makes room)"""
+        if not self.rate or self.windowFull or self.tokens >= size:
+            return None
+        return self.lastRefill + (size - self.tokens) / self.rate
+    
+    def onAck(self, size):
+        self.inFlight = max(0, self.inFlight - size)
+        if self.window < self.slowStartThreshold:
+            self.window += size
+        else:
+            self.window += self.mtu * size / self.window
+        self.window = min(self.window, self.maxWindow)
+    
+    def onLoss(self, t, rtt):
+        """Called for retransmissions, the window is halved at most once per rtt"""
+        self.losses += 1
+        if t - self.lastDecrease > rtt:
+            self.lastDecrease = t
+            self.window = max(self.minWindow, self.window / 2)
+            self.slowStartThreshold = self.window
+    
+    def __repr__(self):
+        return '<CongestionControl window={:.0f} inFlight={} rate={}>'.format(self.window, self.inFlight, self.rate)
@@ -0,0 +1,196 @@
+import struct
+from transmitter.ByteBuffer import encodeVarint, zigzag
+from transmitter.Message import Message
+
+import logging
+logger = logging.getLogger(__name__)
+
+# versions of an object the receiver keeps as baselines
+WINDOW = 32
+# version, version - baseline version (0: all fields are sent)
+_header = struct.Struct('!LB')
+_msgID = struct.Struct('!l')
+
+def _differs(value, old):
+    if value is old:
+        return False
+    if isinstance(value, Message) or (isinstance(value, list) and value and isinstance(value[0], Message)):
+        # messages do not compare by value (see Message.__eq__)
+        return True
+    try:
+        return bool(value != old)
+    except (TypeError, ValueError):
+        # numpy arrays do not compare to a bool
+        return True
+
+class _Versions(object):
+    """The versions of one object (a message class and msgDeltaKey value) sent to a peer"""
+    def __init__(self):
+        self.version = 0
+        # (version, values) the peer acknowledged last
+        self.baseline = None
+        # values of the versions sent, but not acknowledged yet
+        self.sent = {}
+
+class DeltaEncoder(object):
+    """Encodes messages of classes with msgDelta for a peer: only the fields, which
+    differ from the last version the peer acknowledged, are sent with a bitmask of them.
+    Without an acknowledged version (or one too old for the peer to keep) all fields are sent.
+    The versions of at most maxObjects objects are kept, the least recently sent are forgotten."""
+    def __init__(self, maxPending=4096, maxObjects=4096):
+        # least recently sent first
+        self.objects = {}
+        self.maxObjects = maxObjects
+        # sequenceNumber: (_Versions, version), until acknowledged
+        self._pending = {}
+        self.maxPending = maxPending
+        # statistics
+        self.full = 0
+        self.deltas = 0
+        self.fullBytes = 0
+        self.deltaBytes = 0
+    
+    def encode(self, tmsg, maxSize=None):
+        """Replaces the payload of tmsg (its compactPayload if it is compact) by its delta encoding
+        of the values msg had when it was sent.
+        Returns False and leaves tmsg as it is, if the encoded tmsg would be larger than maxSize"""
+        msg = tmsg.msg
+        compact = tmsg.compact
+        codec = msg._getCodec(compact)
+        values = tmsg.values
+        key = (msg.msgID, values[codec.deltaKey] if codec.deltaKey is not None else None)
+        versions = self.objects.get(key)
+        version = versions.version + 1 if versions else 1
+        baseline = versions.baseline if versions else None
+        full = baseline is None or version - baseline[0] >= WINDOW
+        if full:
+            offset = 0
+            indices = range(len(values))
+        else:
+            offset = version - baseline[0]
+            old = baseline[1]
+            indices = [i for i, value in enumerate(values) if _differs(value, old[i]) or i == codec.deltaKey]
+        mask = 0
+        for i in indices:
+            mask |= 1 << i
+        msgID = encodeVarint(zigzag(msg.msgID)) if compact else _msgID.pack(msg.msgID)
+        payload = b''.join((msgID, _header.pack(version, offset), mask.to_bytes(codec.maskSize, 'little'),
+            codec.subset(indices).encode([values[i] for i in indices])))
+        plain = tmsg.compactPayload if compact else tmsg.payload
+        if maxSize is not None and tmsg.size - len(plain) + len(payload) > maxSize:
+            # a split delta would be read as a plain message, it is sent without delta encoding
+            return False
+        
+        if versions is None:
+            versions = _Versions()
+            if len(self.objects) >= self.maxObjects:
+                # not sent for the longest time, it starts over with all fields
+                del self.objects[next(iter(self.objects))]
+        else:
+            del self.objects[key]
+        self.objects[key] = versions
+        versions.version = version
+        if full:
+            self.full += 1
+        else:
+            self.deltas += 1
+        self.deltaBytes += len(payload)
+        self.fullBytes += len(plain)
+        if compact:
+            tmsg._compactPayload = payload
+        else:
+            tmsg._payload = payload
+        tmsg.delta = True
+        
+        versions.sent[version] = values
+        # too old to be a baseline
+        versions.sent.pop(version - WINDOW, None)
+        self._pending[tmsg.sequenceNumber] = (versions, version)
+        if len(self._pending) > self.maxPending:
+            # forget the oldest, it will not be acknowledged anymore
+            del self._pending[next(iter(self._pending))]
+        return True
+    
+    def acknowledged(self, sequenceNumber):
+        try:
+            versions, version = self._pending.pop(sequenceNumber)
+        except KeyError:
+            return
+        values = versions.sent.get(version)
+        if values is None:
+            return
+        versions.baseline = (version, values)
+        # older versions are no baseline anymore
+        for v in [v for v in versions.sent if v <= version]:
+            del versions.sent[v]
+    
+    @property
+    def ratio(self):
+        """Bytes sent per byte of the full messages"""
+        return self.deltaBytes / self.fullBytes if self.fullBytes else 1
+    
+    def __repr__(self):
+        return '<DeltaEncoder objects={} full={} deltas={} ratio={:.2f}>'.format(
+            len(self.objects), self.full, self.deltas, self.ratio)
+
+class DeltaDecoder(object):
+    """Rebuilds the messages encoded by the DeltaEncoder of a peer
+    from the last WINDOW versions of every object received.
+    The versions of at most maxObjects objects are kept, the least recently received are forgotten
+    (a delta against them is not decoded, so not acknowledged, until all fields are sent again)"""
+    def __init__(self, maxObjects=8192):
+        # least recently received first
+        self.objects = {}
+        self.maxObjects = maxObjects
+        self._masks = {}
+        # deltas, which could not be decoded, because their baseline is unknown
+        self.missingBaselines = 0
+    
+    def decode(self, clas, byteBuffer, compact=False):
+        """Returns the message read from byteBuffer (msgID is read already),
+        None if its baseline is unknown"""
+        codec = clas._getCodec(compact)
+        version, offset = byteBuffer.unpack(_header)
+        indices = self._indices(byteBuffer.read(codec.maskSize), len(codec.names))
+        changed = codec.subset(indices).decode(byteBuffer)
+        
+        key = None
+        if codec.deltaKey is not None:
+            key = changed[indices.index(codec.deltaKey)]
+        versions = self.objects.pop((clas.msgID, key), None)
+        if versions is None:
+            versions = {}
+            if len(self.objects) >= self.maxObjects:
+                del self.objects[next(iter(self.objects))]
+        self.objects[(clas.msgID, key)] = versions
+        if offset:
+            baseline = versions.get(version - offset)
+            if baseline is None:
+                self.missingBaselines += 1
+                logger.debug('Discarding delta of %s, baseline %s unknown', clas.__name__, version - offset)
+                return None
+            values = list(baseline)
+            for i, value in zip(indices, changed):
+                values[i] = value
+        else:
+            values = changed
+        versions[version] = values
+        if len(versions) > WINDOW:
+            for v in [v for v in versions if v <= version - WINDOW]:
+                del versions[v]
+        msg = clas()
+        msg._setValues(codec.names, values)
+        return msg
+    
+    def _indices(self, mask, n):
+        try:
+            return self._masks[mask, n]
+        except KeyError:
+            if len(self._masks) > 1024:
+                self._masks.clear()
+            bits = int.from_bytes(mask, 'little')
+            indices = self._masks[mask, n] = [i for i in range(min(bits.bit_length(), n)) if bits >> i & 1]
+            return indices
+    
+    def __repr__(self):
+        return '<DeltaDecoder objects={} missingBaselines={}>'.format(len(self.objects), self.missingBaselines)
@@ -1,20 +1,55 @@
+import os
 import socket
-from threading import Thread
+import struct
+import itertools
+from threading import Thread, Lock
 import queue
 from collections import deque
 from time import time
-import copy
 from transmitter.Event import Event
-from transmitter.Message import Message, MessageFactory, TransportMessage
-from transmitter.ByteBuffer import ByteBuffer
+from transmitter.Message import Message, MessageFactory, TransportMessage, TCompressed
+from transmitter.ByteBuffer import ByteBuffer, encodeVarint, unzigzag
 from transmitter.Measurement import Measurement
 from transmitter.PingSampler import PingSampler
+from transmitter.RTTEstimator import RTTEstimator
+from transmitter.CongestionControl import CongestionControl
 from transmitter.BitField import BitField
+from transmitter.SequenceWindow import SequenceWindow
+from transmitter.Notifier import Notifier
+from transmitter.Reassembler import Reassembler
+from transmitter.OutgoingStream import OutgoingStream
+from transmitter.Compression import Compression, ALGORITHM, presetDictionary, dictionaryID
+from transmitter.Delta import DeltaEncoder, DeltaDecoder
+from transmitter.Channel import OrderedChannel, SequencedChannel, SEQUENCED
+from transmitter.Scheduler import Scheduler, PRIORITIES
 
 import logging
 logger = logging.getLogger(__name__)
 
-PROTOCOL = 2
+PROTOCOL = 8
+# older protocols we still accept connections from
+# 2: one TAcknowledgement per reliable message
+# 3: no compression (TCompression, TCompressed)
+# 4: no delta encoded messages (Message.msgDelta)
+# 5: no compact packets (varint headers)
+# 6: no channels (ordered messages are delivered as received)
+# 7: 32 bit sequenceNumbers in acknowledgements (TAcknowledgements32)
+SUPPORTED_PROTOCOLS = (2, 3, 4, 5, 6, 7, 8)
+
+# receive without blocking, not available on every platform
+_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)
+# largest UDP datagram, what arrives is read whole whatever mtu is
+MAX_DATAGRAM = 65535
+
+# TransportMessage header followed by msgID
+_messageHeader = struct.Struct('!QBl')
+# first byte of a compact packet, followed by the sequenceNumber of the packet (varint)
+# and the messages: sequenceNumber difference (zigzag varint), flags,
+# channel and channel sequence (varint, if flags & 8), compact payload.
+# Other packets start with the high byte of a sequenceNumber, which is 0
+COMPACT_PACKET = 6
+# most bytes a compact packet has besides its messages (marker, 64 bit varint)
+_compactOverhead = 11
 
 class Endpoint(object):
     """A NetworkEndpoint is a flexible interface for a Server and Client."""
@@ -28,21 +63,57 @@ class Endpoint(object):
     
     isServer = False
     isClient = False
+    # what wait() and fileno() use, see AsyncEndpoint
+    _Notifier = Notifier
     
     def __init__(self):
         self.accepting = False
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # let other processes bind the same address (see ShardedServer)
+        self.reusePort = False
         self.peers = {}
         self.connectPeer = None
         self._lastPeerID = -1 if self.isClient else 0
         self.addr = None
         
         self._receivingThread = None
+        # set when update() has work to do
+        self._notifier = self._Notifier()
+        self.closed = False
         
         self.state = self.DISCONNECTED
         self.mtu = 1400
+        # max number of datagrams read from the socket before they are processed
+        self.receiveBatchSize = 64
+        # protocol to request when connecting
+        self.protocol = PROTOCOL
         self.timeout = 10
         self.pingInterval = 2
+        # bounds of the retransmission timeout of the peers
+        self.minRTO = 0.05
+        self.maxRTO = 10
+        # give new peers a CongestionControl, pacing them to sendRate bytes/s (None: unlimited)
+        self.congestionControl = False
+        self.sendRate = None
+        # number of sequenceNumbers remembered per peer to discard duplicates
+        self.duplicateWindow = 65536
+        # memory for reassembling split messages, per peer and for all peers
+        # split messages exceeding it are dropped, ones not progressing for reassemblyTimeout are evicted
+        self.maxPeerReassemblyBytes = 16 * 2**20
+        self.maxReassemblyBytes = 64 * 2**20
+        self.reassemblyTimeout = 10
+        # messages of an ordered channel, which wait for earlier ones, at most (per channel)
+        self.reorderWindow = 256
+        # max number of unacknowledged parts of a split message or stream per peer
+        self.streamWindow = 128
+        # compress packets and split payloads of at least compressionThreshold bytes,
+        # if the peer agrees, with a preset dictionary built from the registered messages
+        self.compression = False
+        self.compressionLevel = 6
+        self.compressionThreshold = 256
+        self.compressionDictionary = True
+        self.reassemblyBytes = 0
+        self._reassemblyLock = Lock()
         
         self.pendingDisconnect = False
         
@@ -55,13 +126,13 @@ class Endpoint(object):
         
         self.messageFactory = MessageFactory()
         # NO TransportMessages
-        self.receivedMessages = queue.Queue()
+        # deque, because appending and popping is threadsafe without locking
+        self.receivedMessages = deque()
         self.onMessage = Event()
         self.onConnect = Event()
         self.onDisconnect = Event()
         self.onTimeout = Event()
         
-        self.lastOutgoingSequenceNumber = 0
         self.lastSplitMessageNumber = 0
         
         # TransportMessages
@@ -81,6 +152,8 @@ class Endpoint(object):
     
     def bind(self, addr):
         self.addr = addr
+        if self.reusePort:
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._socket.bind(addr)
         self.accepting = True
         self.state = self.LISTENING
@@ -92,7 +165,8 @@ class Endpoint(object):
         self.state = self.CONNECTING
         # we need a peer to send data, but we remove it as soon as possible
         self.connectPeer = self._newPeer(self.addr, append=False)
-        self.connectPeer.send(self.messageFactory.getByName('TConnectRequest')(protocol=PROTOCOL))
+        self.connectPeer.protocol = self.protocol
+        self.connectPeer.send(self.messageFactory.getByName('TConnectRequest')(protocol=self.protocol))
     
     def start(self):
         if not self.addr:
@@ -108,30 +182,77 @@ class Endpoint(object):
         self.pendingDisconnect = True
         self.state = self.DISCONNECTED
     
-    def update(self):
-        """Call this method regularly"""
+    def update(self, timeout=0):
+        """Call this method regularly
+        With a timeout, it first waits (see wait) at most timeout seconds, None waits without limit"""
+        if timeout != 0:
+            self.wait(timeout)
+        self._notifier.clear()
         while True:
             try:
-                msg, peer = self.receivedMessages.get(False)
-            except queue.Empty:
+                msg, peer = self.receivedMessages.popleft()
+            except IndexError:
                 break
-            if msg.msgID >= 0:
-                self.onMessage(msg, peer)
-            else:
-                if msg == 'TConnect':
-                    self.onConnect(peer)
-                elif msg == 'TDisconnect':
-                    self.onDisconnect(peer)
-                elif msg == 'TTimeout':
-                    self.onTimeout(peer)
-        self.removeDeadPeers()
+            self._handleMessage(msg, peer)
         self.updatePeers()
         self.sendOutgoingMessages()
+        self.removeDeadPeers()
         if self.pendingDisconnect and not self.peers:
-            self._socket.close()
+            self._close()
+    
+    def _handleMessage(self, msg, peer):
+        """Fires the event for a received message"""
+        if msg.msgID >= 0:
+            self.onMessage(msg, peer)
+        else:
+            if msg == 'TConnect':
+                self.onConnect(peer)
+            elif msg == 'TDisconnect':
+                self.onDisconnect(peer)
+            elif msg == 'TTimeout':
+                self.onTimeout(peer)
+    
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._socket.close()
+        self._notifier.close()
+    
+    def _wakeUp(self):
+        """Called when there is something to send or received messages to handle"""
+        self._notifier.set()
+    
+    def wait(self, timeout=None):
+        """Blocks until messages were received, a message was sent or a deadline
+        of a peer (ping, retransmission, timeout) passed, but at most timeout seconds
+        Returns True, if update() has work to do"""
+        if self.closed:
+            return False
+        deadline = self.nextDeadline()
+        if deadline is not None:
+            remaining = max(0, deadline - time())
+            if timeout is None or remaining < timeout:
+                self._notifier.wait(remaining)
+                return True
+        return self._notifier.wait(timeout)
+    
+    def fileno(self):
+        """A file descriptor, which becomes readable when update() has work to do
+        (except for deadlines, see nextDeadline), to use the endpoint in a select loop"""
+        return self._notifier.fileno()
+    
+    def nextDeadline(self):
+        """Returns the time, when update() has work to do next (without new messages)
+        or None, if there is nothing to wait for"""
+        deadlines = [peer.nextDeadline() for peer in list(self.peers.values()) + [self.connectPeer] if peer]
+        deadlines = [deadline for deadline in deadlines if deadline is not None]
+        return min(deadlines) if deadlines else None
     
     def send(self, msg, exclude=[], **flags):
-        tmsg = TransportMessage(msg, self.nextOutgoingSequenceNumber, **flags)
+        tmsg = TransportMessage(msg, **flags)
+        # encode msg once, the peers share the payload
+        tmsg.payload
         if self.active:
             for _id, peer in list(self.peers.items())[:]:
                 if _id not in exclude:
@@ -145,18 +266,36 @@ class Endpoint(object):
         self.bytesOut += self._socket.sendto(data, addr)
         self.packetsOut += 1
     
-    def _read(self):
-        result = self._socket.recvfrom(self.mtu)
-        # result -> (data, addr)
-        self.bytesIn += len(result[0])
-        self.packetsIn += 1
-        return result
+    def _readBatch(self, buffer):
+        """Blocks until a datagram arrives, then reads all the datagrams,
+        which are ready, without blocking one after another into the preallocated buffer,
+        as long as a datagram of any size fits into the rest of it.
+        Returns a list of (memoryview, addr), only valid until the next call"""
+        batch = []
+        size = 0
+        flags = 0
+        while len(buffer) - size >= MAX_DATAGRAM and len(batch) < self.receiveBatchSize:
+            try:
+                n, addr = self._socket.recvfrom_into(buffer[size:], MAX_DATAGRAM, flags)
+            except BlockingIOError:
+                break
+            batch.append((buffer[size:size + n], addr))
+            size += n
+            if _DONTWAIT is None:
+                break
+            flags = _DONTWAIT
+        self.bytesIn += size
+        self.packetsIn += len(batch)
+        return batch
     
     def _putMessage(self, msg, peer):
-        self.receivedMessages.put((copy.deepcopy(msg), peer), False)
+        self.receivedMessages.append((msg, peer))
     
     def _newPeer(self, addr, append=True):
         peer = Peer(self, addr, self.nextPeerID)
+        if self.connectPeer:
+            # the server has seen the sequenceNumbers of the connect request already
+            peer._sequenceNumbers = self.connectPeer._sequenceNumbers
         if append:
             self.peers[peer.id] = peer
         return peer
@@ -177,27 +316,64 @@ class Endpoint(object):
                 pass
     
     def _receive(self):
+        buffer = None
         while True:
-            data, addr = self._read()
-            peer = self.getPeerByAddr(addr)
-            if not peer:
-                if not self.accepting:
-                    continue
-                peer = self._newPeer(addr)
-            self._processData(data, peer)
+            if buffer is None or len(buffer) != self.receiveBatchSize * self.mtu + MAX_DATAGRAM:
+                # room for a batch of datagrams of mtu, mtu or receiveBatchSize may be changed any time
+                buffer = memoryview(bytearray(self.receiveBatchSize * self.mtu + MAX_DATAGRAM))
+            try:
+                batch = self._readBatch(buffer)
+            except OSError:
+                if self.closed:
+                    # the socket was closed by update
+                    return
+                raise
+            for data, addr in batch:
+                peer = self.getPeerByAddr(addr)
+                if not peer:
+                    if not self.accepting:
+                        continue
+                    peer = self._newPeer(addr)
+                self._processData(data, peer)
+            self._wakeUp()
     
-    def _processData(self, data, peer):
+    def _processData(self, data, peer, decompress=True):
         byteBuffer = ByteBuffer(data)
+        compact = len(byteBuffer) > 0 and data[0] == COMPACT_PACKET
+        if compact:
+            byteBuffer.readView(1)
+            base = byteBuffer.readVarint()
         while len(byteBuffer):
+            channelID = None
+            if compact:
+                sequenceNumber = base + unzigzag(byteBuffer.readVarint())
+                flags = byteBuffer.readByte()
+                if flags & 8:
+                    channelID = byteBuffer.readByte()
+                    channelSequence = byteBuffer.readVarint()
+                msgID = unzigzag(byteBuffer.readVarint())
+            else:
+                sequenceNumber, flags, msgID = byteBuffer.unpack(_messageHeader)
+            if flags & 4:
+                # delta encoded, rebuilt from a version received before
+                msg = peer.deltaDecoder.decode(self.messageFactory.getByID(msgID), byteBuffer, compact)
+                if msg is None:
+                    continue
+            else:
+                msg = self.messageFactory.getByID(msgID)()
+                msg._readFromByteBuffer(byteBuffer, compact)
+            if msgID == TCompressed.msgID:
+                # the rest of the packet was compressed
+                data = peer._decompress(msg, 65536) if decompress else None
+                if data is not None:
+                    self._processData(data, peer, False)
+                continue
             self.messagesIn += 1
-            
-            sequenceNumber = byteBuffer.readStruct('Q')[0]
-            flags = BitField(byteBuffer.readStruct('B')[0])
-            msgID = byteBuffer.readStruct('l')[0]
-            msg = self.messageFactory.getByID(msgID)()
-            msg._readFromByteBuffer(byteBuffer)
+            flags = BitField(flags)
             tmsg = TransportMessage(msg, sequenceNumber)
             tmsg.flags = flags
+            if channelID is not None:
+                tmsg.setChannel(channelID, channelSequence)
             
             self._processMessage(tmsg, peer)
     
@@ -208,26 +384,32 @@ class Endpoint(object):
     def removeDeadPeers(self):
         dead = []
         for _id, peer in self.peers.items():
-            if peer.pendingDisconnect and not peer.outgoingMessages:
+            if peer.dead:
                 dead.append(_id)
         for _id in dead:
-            self.peers.pop(_id)
+            self.peers.pop(_id).reassembler.clear()
     
     def processConnectRequest(self, msg, peer):
         if self.isServer and self.state == self.LISTENING:
             logger.debug('Received ConnectRequest: %s %s', msg, peer)
-            if msg.protocol == PROTOCOL:
+            if msg.protocol in SUPPORTED_PROTOCOLS:
+                peer.protocol = msg.protocol
+                peer.compact = peer.protocol >= 6
                 peer.send(self.messageFactory.getByName('TConnectRequestAccepted')())
+                if self.compression and peer.protocol >= 4:
+                    peer._offerCompression()
                 logger.info('Accepting Request')
                 self._putMessage(self.messageFactory.getByName('TConnect')(), peer)
             else:
                 peer.send(self.messageFactory.getByName('TConnectRequestRejected')())
-                logger.info('Rejecting Request: msg: %s our: %s', msg.protocol, PROTOCOL)
+                logger.info('Rejecting Request: msg: %s our: %s', msg.protocol, SUPPORTED_PROTOCOLS)
                 peer.pendingDisconnect = True
     
     def processConnectRequestAccepted(self, peer):
         if self.isClient and self.state == self.CONNECTING:
             logger.info('Server accepted connection')
+            peer.protocol = self.protocol
+            peer.compact = peer.protocol >= 6
             self.accepting = False
             self.connectPeer = None
             self.state = self.CONNECTED
@@ -276,58 +458,198 @@ class Endpoint(object):
         self._lastPeerID += 1
         return self._lastPeerID
     
-    @property
-    def nextOutgoingSequenceNumber(self):
-        self.lastOutgoingSequenceNumber += 1
-        return self.lastOutgoingSequenceNumber
-    
     @property
     def nextSplitMessageNumber(self):
         self.lastSplitMessageNumber += 1
         return self.lastSplitMessageNumber
 
 class Peer(object):
+    # number of sequenceNumbers a TAcknowledgements covers besides its own
+    ACK_MASK_BITS = 256
+    
     def __init__(self, endpoint, addr, _id):
         self.endpoint = endpoint
         self.addr = addr
         self.id = _id
         
         self.pendingDisconnect = False
+        # negotiated during connect, assume the oldest until then
+        self.protocol = SUPPORTED_PROTOCOLS[0]
+        # messages are sent in compact packets (protocol 6)
+        self.compact = False
         
         self.pingSampler = PingSampler(0.2)
         self.lastPingTime = 0
         self.lastPingNumber = 0
+        self.rttEstimator = RTTEstimator(minRTO=endpoint.minRTO, maxRTO=endpoint.maxRTO)
+        self.retransmits = 0
+        # retransmissions, which turned out to be unnecessary
+        self.spuriousRetransmits = 0
         
-        # TransportMessages
-        self.outgoingMessages = deque()
+        # unacknowledged reliable TransportMessages by sequenceNumber
+        self.outgoingMessages = {}
         self.newMessages = queue.Queue()
-        # SequenceNumbers
+        # TransportMessages taken from newMessages, but not sent yet, by priority
+        self.scheduler = Scheduler()
+        # OutgoingStreams, which have parts left to send
+        self.streams = deque()
+        # OutgoingStream of the unacknowledged parts by sequenceNumber
+        self._streamParts = {}
+        # packets are built in here
+        self._packetBuffer = bytearray(endpoint.mtu)
+        self.congestionControl = None
+        if endpoint.congestionControl:
+            self.congestionControl = CongestionControl(endpoint.mtu, rate=endpoint.sendRate)
+        # (SequenceNumber, time received)
         self.receivedAcknowledgements = queue.Queue()
+        # SequenceNumbers
+        self.pendingAcknowledgements = queue.Queue()
         # Queue because we access it from multiple threads
         
-        self.lastIncommingSequenceNumber = 0
-        self.recentIncommingSequenceNumbers = []
+        self.recentIncommingSequenceNumbers = SequenceWindow(endpoint.duplicateWindow)
+        self.duplicatesDiscarded = 0
         
         self.lastReceiveTime = 0
         
-        self.receivedMessageParts = {}
+        self.reassembler = Reassembler(endpoint, self._lostSplitMessage)
+        # OrderedChannels and SequencedChannels by channelID (protocol 7)
+        self.channels = {}
+        # messages are received by the receiving thread, split messages are evicted by update
+        self._channelLock = Lock()
+        # channel sequence numbers of the sent messages by channelID
+        self._channelSequences = {}
+        # (channel, channel sequence) of split messages by splitMessageNumber
+        self._splitChannels = {}
+        # negotiated when connecting, None if the packets are not compressed
+        self.compression = None
+        self.deltaEncoder = DeltaEncoder()
+        self.deltaDecoder = DeltaDecoder()
+        
+        # sequenceNumbers are counted per peer
+        # (next() of a count is atomic, messages are sent from both threads)
+        self._sequenceNumbers = itertools.count(1)
     
     @property
     def latency(self):
         return self.pingSampler.average
     
+    @property
+    def nextOutgoingSequenceNumber(self):
+        return next(self._sequenceNumbers)
+    
+    @property
+    def realRetransmits(self):
+        return self.retransmits - self.spuriousRetransmits
+    
+    @property
+    def dead(self):
+        """Disconnected and nothing left to send"""
+        return (self.pendingDisconnect and not self.outgoingMessages and not self.scheduler
+            and not self.streams and self.newMessages.empty() and self.pendingAcknowledgements.empty())
+    
     def send(self, msg, **flags):
-        tmsg = TransportMessage(msg, self.endpoint.nextOutgoingSequenceNumber, **flags)
+        tmsg = TransportMessage(msg, **flags)
         self._send(tmsg)
     
     def _send(self, tmsg):
         if not self.pendingDisconnect:
-            self.newMessages.put(copy.deepcopy(tmsg), False)
+            tmsg = tmsg.copy(self.nextOutgoingSequenceNumber, self.compact)
+            if tmsg.channel is not None:
+                self._numberInChannel(tmsg, tmsg.channel, tmsg.reliable)
+            if tmsg.compact and tmsg.size > self.maxMessageSize:
+                # split messages are sent in the plain layout, encoded now like compactPayload
+                tmsg.payload
+            self.newMessages.put(tmsg, False)
+            self.endpoint._wakeUp()
+    
+    def _numberInChannel(self, tmsg, channel, reliable):
+        """Gives tmsg (a TransportMessage or OutgoingStream) the next sequence of channel,
+        reliable and unreliable messages are numbered separately"""
+        if not self.compact or self.protocol < 7:
+            return
+        channelID = channel if reliable else channel | SEQUENCED
+        # setdefault is atomic, messages are sent from both threads
+        sequences = self._channelSequences.setdefault(channelID, itertools.count(1))
+        tmsg.setChannel(channelID, next(sequences))
+    
+    def sendStream(self, msg, name, source, size=None):
+        """Sends msg reliably, with the data of its bytes field name read from source
+        while it is sent, instead of from msg. source is bytes-like, a file-like object
+        or an iterable of bytes-like chunks, size is its length in bytes
+        (for files it defaults to the rest of the file, an iterable needs it)"""
+        if size is None:
+            size = self._sourceSize(source)
+        codec = msg._getCodec()
+        head, tail = codec.encodeAround(codec.values(msg), name, size)
+        stream = OutgoingStream.fromSource(head, source, size, tail, self.endpoint.mtu - 25)
+        stream.priority = msg.msgPriority
+        channel = msg.msgChannel if msg.msgChannel is not None else 0 if msg.msgOrdered else None
+        if channel is not None:
+            self._numberInChannel(stream, channel, True)
+        if not self.pendingDisconnect:
+            self.newMessages.put(stream, False)
+            self.endpoint._wakeUp()
+        return stream
+    
+    @staticmethod
+    def _sourceSize(source):
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return memoryview(source).nbytes
+        try:
+            return os.fstat(source.fileno()).st_size - source.tell()
+        except (AttributeError, OSError, ValueError):
+            pass
+        try:
+            position = source.tell()
+            size = source.seek(0, os.SEEK_END) - position
+            source.seek(position)
+            return size
+        except (AttributeError, OSError, ValueError):
+            raise ValueError('size of the source is unknown, pass size')
     
     def _sendAcknowledgement(self, sequenceNumber):
-        msg = self.endpoint.messageFactory.getByName(
-            'TAcknowledgement')(sequenceNumber=sequenceNumber)
-        tmsg = TransportMessage(msg, self.endpoint.nextOutgoingSequenceNumber)
+        # acknowledgements are collected and sent once per update
+        self.pendingAcknowledgements.put(sequenceNumber, False)
+    
+    def _flushAcknowledgements(self):
+        sequenceNumbers = set()
+        while True:
+            try:
+                sequenceNumbers.add(self.pendingAcknowledgements.get(False))
+            except queue.Empty:
+                break
+        if not sequenceNumbers:
+            return
+        if self.protocol < 3:
+            Msg = self.endpoint.messageFactory.getByName('TAcknowledgement')
+            for sequenceNumber in sequenceNumbers:
+                self._queueAcknowledgement(Msg(sequenceNumber=sequenceNumber))
+            return
+        # the newest sequenceNumber and a bitmask of the preceding ones
+        # sequenceNumbers outside the mask are acknowledged by another message.
+        # There is no cumulative ack: reliable and unreliable messages share the sequenceNumbers,
+        # so one lost unreliable message would stop it, and we can't tell which numbers need one.
+        # Lost acknowledgements are made up for, as a message received again is acknowledged again.
+        Msg = self.endpoint.messageFactory.getByName('TAcknowledgements' if self.protocol >= 8 else 'TAcknowledgements32')
+        sequenceNumbers = sorted(sequenceNumbers, reverse=True)
+        while sequenceNumbers:
+            base = sequenceNumbers[0]
+            mask = 0
+            rest = []
+            for sequenceNumber in sequenceNumbers[1:]:
+                d = base - sequenceNumber
+                if d <= self.ACK_MASK_BITS:
+                    mask |= 1 << (d - 1)
+                else:
+                    rest.append(sequenceNumber)
+            mask = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+            self._queueAcknowledgement(Msg(sequenceNumber=base, mask=mask))
+            sequenceNumbers = rest
+    
+    def _queueAcknowledgement(self, msg):
+        tmsg = TransportMessage(msg, self.nextOutgoingSequenceNumber)
+        # in the compact packet with the other messages
+        tmsg.compact = self.compact
         self.newMessages.put(tmsg, False)
     
     def disconnect(self):
@@ -336,31 +658,70 @@ class Peer(object):
         self.endpoint._peerDisconnect(self)
     
     def processIncommingMessage(self, tmsg):
-        self.lastReceiveTime = time()
+        t = time()
+        self.lastReceiveTime = t
+        
+        channel = None
+        if tmsg.channelID is not None:
+            channel = self.channels.get(tmsg.channelID)
+            if channel is None:
+                if tmsg.channelID & SEQUENCED:
+                    channel = SequencedChannel()
+                else:
+                    channel = OrderedChannel(self.endpoint.reorderWindow)
+                self.channels[tmsg.channelID] = channel
+            if tmsg.msg != 'TMessageStart' and not channel.accepts(tmsg.channelSequence):
+                # the reorder buffer is full, the message is sent again, as it is not acknowledged
+                logger.debug('Refusing message beyond reorder buffer: %s', tmsg)
+                return self.endpoint.MESSAGE_HANDLED
         
-        if tmsg.reliable:
+        if tmsg.reliable or tmsg.delta:
             # message requires acknowledgement
             logger.debug('Acking: %s', tmsg)
             self._sendAcknowledgement(tmsg.sequenceNumber)
         
-        self.recentIncommingSequenceNumbers = \
-            self.recentIncommingSequenceNumbers[-1000:]
-        if tmsg.sequenceNumber in self.recentIncommingSequenceNumbers:
-            # message received twice, discard it
+        if not self.recentIncommingSequenceNumbers.add(tmsg.sequenceNumber):
+            # message received twice (or too old to tell), discard it
             logger.info('Message received twice - discarding it: %s', tmsg)
-            return self.endpoint.MESSAGE_HANDLED
-        self.recentIncommingSequenceNumbers.append(tmsg.sequenceNumber)
-        
-        if tmsg.ordered and tmsg.sequenceNumber < self.lastIncommingSequenceNumber:
-            # newer message was received, discard it
-            # nevertheless, the acknownledgement might be sent
-            logger.info('Discarding late ordered message: %s', tmsg)
+            self.duplicatesDiscarded += 1
             return self.endpoint.MESSAGE_HANDLED
         
+        if channel is None:
+            return self._dispatchMessage(tmsg.msg)
         msg = tmsg.msg
-        
+        if msg == 'TMessageStart':
+            # the split message takes its place in the channel, when it is reassembled
+            self._splitChannels[msg.splitMessageNumber] = (channel, tmsg.channelSequence)
+            with self._channelLock:
+                messages = channel.pending(tmsg.channelSequence)
+            self._deliver(messages)
+            self._dispatchMessage(msg)
+        else:
+            with self._channelLock:
+                messages = channel.receive(tmsg.channelSequence, msg)
+            self._deliver(messages)
+        return self.endpoint.MESSAGE_HANDLED
+    
+    def _deliver(self, messages):
+        for msg in messages:
+            if self._dispatchMessage(msg) == self.endpoint.MESSAGE_UNHANDLED:
+                self.endpoint._putMessage(msg, self)
+    
+    def _dispatchMessage(self, msg):
+        """Processes transport messages
+        Returns MESSAGE_UNHANDLED for messages, which are passed to the application"""
         if msg == 'TAcknowledgement':
-            self._receivedAcknowledgement(msg.sequenceNumber)
+            self._receivedAcknowledgement(msg.sequenceNumber, time())
+        elif msg == 'TAcknowledgements' or msg == 'TAcknowledgements32':
+            t = time()
+            self._receivedAcknowledgement(msg.sequenceNumber, t)
+            mask = int.from_bytes(msg.mask, 'little')
+            d = 1
+            while mask:
+                if mask & 1:
+                    self._receivedAcknowledgement(msg.sequenceNumber - d, t)
+                mask >>= 1
+                d += 1
         
         elif msg == 'TConnectRequest':
             self.endpoint.processConnectRequest(msg, self)
@@ -369,138 +730,389 @@ class Peer(object):
         elif msg == 'TConnectRequestRejected':
             self.endpoint.processConnectRequestRejected()
         
+        elif msg == 'TCompression':
+            self._negotiateCompression(msg)
+        
         elif msg == 'TPing':
             self.send(self.endpoint.messageFactory.getByName('TPong')(pingNumber=msg.pingNumber))
         elif msg == 'TPong':
             if msg.pingNumber == self.lastPingNumber:
-                self.pingSampler += time() - self.lastPingTime
+                rtt = time() - self.lastPingTime
+                self.pingSampler += rtt
+                self.rttEstimator += rtt
         
         elif msg == 'TDisconnect':
             self.pendingDisconnect = True
-            self.outgoingMessages.clear()
+            self._clearOutgoing()
             self.endpoint._peerDisconnect(self)
         
         elif msg == 'TMessageStart':
-            msg.part = 0
-            self.receivedMessageParts.setdefault(
-                msg.splitMessageNumber, {'max': msg.parts, 'msg': []})['msg'].append(copy.deepcopy(msg))
-            self._checkForCompleteSplitMessage(msg.splitMessageNumber)
+            self._receivedSplitMessage(msg.splitMessageNumber,
+                self.reassembler.start(msg.splitMessageNumber, msg.parts, msg.data, time()))
         elif msg == 'TMessagePart':
-            self.receivedMessageParts.setdefault(
-                msg.splitMessageNumber, {'max': -1, 'msg': []})['msg'].append(copy.deepcopy(msg))
-            self._checkForCompleteSplitMessage(msg.splitMessageNumber)
+            self._receivedSplitMessage(msg.splitMessageNumber,
+                self.reassembler.add(msg.splitMessageNumber, msg.part, msg.data, time()))
         
         else:
             return self.endpoint.MESSAGE_UNHANDLED
         
         return self.endpoint.MESSAGE_HANDLED
     
-    def _checkForCompleteSplitMessage(self, splitMessageNumber):
-        d = self.receivedMessageParts[splitMessageNumber]
-        if len(d['msg']) == d['max']:
-            data = b''
-            for part in sorted(self.receivedMessageParts[splitMessageNumber]['msg'], 
-                    key=lambda item: item.part if hasattr(item, 'part') else 0):
-                data += part.data
-            # VERY HACKY - Improvement needed (more centralized / do in Peer)
-            byteBuffer = ByteBuffer(data)
-            msgID = byteBuffer.readStruct('l')[0]
-            msg = self.endpoint.messageFactory.getByID(msgID)()
-            msg._readFromByteBuffer(byteBuffer)
-            tmsg = TransportMessage(msg, self.endpoint.nextOutgoingSequenceNumber)
-            self.endpoint._processMessage(tmsg, self)
-            del self.receivedMessageParts[splitMessageNumber]
-    
-    def _receivedAcknowledgement(self, sequenceNumber):
-        self.receivedAcknowledgements.put(sequenceNumber, False)
+    def _receivedSplitMessage(self, number, data):
+        """Dispatches the message reassembled from the parts, data is None while it is incomplete"""
+        if data is None:
+            return
+        msg = self.endpoint.messageFactory.fromBytes(data)
+        if msg == 'TCompressed':
+            data = self._decompress(msg, self.endpoint.maxPeerReassemblyBytes)
+            if data is None:
+                self._lostSplitMessage(number)
+                return
+            msg = self.endpoint.messageFactory.fromBytes(data)
+        # the parts went through duplicate detection and were acknowledged already
+        entry = self._splitChannels.pop(number, None)
+        if entry is not None:
+            channel, sequence = entry
+            with self._channelLock:
+                messages = channel.complete(sequence, msg)
+            self._deliver(messages)
+        else:
+            self._deliver((msg,))
+    
+    def _lostSplitMessage(self, number):
+        """Called when the split message number will not be reassembled (dropped or evicted),
+        the messages of its channel, which wait for it, are delivered without it"""
+        entry = self._splitChannels.pop(number, None)
+        if entry is None:
+            return
+        channel, sequence = entry
+        with self._channelLock:
+            messages = channel.skip(sequence)
+        self._deliver(messages)
+        if messages:
+            self.endpoint._wakeUp()
+    
+    def _offerCompression(self):
+        """The server offers compression, it can receive compressed data from now on,
+        but sends it only after the client accepted"""
+        endpoint = self.endpoint
+        dictionary = presetDictionary(endpoint.messageFactory) if endpoint.compressionDictionary else b''
+        self.compression = Compression(endpoint.messageFactory, endpoint.compressionLevel, dictionary)
+        self.compression.sending = False
+        self.send(endpoint.messageFactory.getByName('TCompression')(algorithm=ALGORITHM,
+            dictionary=dictionaryID(dictionary) if dictionary else b''))
+    
+    def _negotiateCompression(self, msg):
+        """The client answers the offer with what it accepts (empty algorithm to decline).
+        The preset dictionary is used, if both sides have the same"""
+        endpoint = self.endpoint
+        if endpoint.isServer:
+            if self.compression is None:
+                return
+            if msg.algorithm != ALGORITHM:
+                self.compression = None
+                return
+            if not msg.dictionary:
+                self.compression.dictionary = b''
+            self.compression.sending = True
+        elif not endpoint.compression or msg.algorithm != ALGORITHM:
+            self.send(endpoint.messageFactory.getByName('TCompression')())
+            return
+        else:
+            dictionary = presetDictionary(endpoint.messageFactory) if endpoint.compressionDictionary else b''
+            if not dictionary or msg.dictionary != dictionaryID(dictionary):
+                dictionary = b''
+            self.compression = Compression(endpoint.messageFactory, endpoint.compressionLevel, dictionary)
+            self.send(endpoint.messageFactory.getByName('TCompression')(algorithm=ALGORITHM,
+                dictionary=dictionaryID(dictionary) if dictionary else b''))
+        logger.info('Compressing with %s, preset dictionary: %s', ALGORITHM, bool(self.compression.dictionary))
+    
+    def _decompress(self, msg, limit):
+        """Returns the data of a TCompressed message, None if it can't be decompressed"""
+        if self.compression is None:
+            logger.warning('Discarding compressed data, compression was not negotiated')
+            return None
+        try:
+            return self.compression.decompress(msg, limit)
+        except ValueError as e:
+            logger.warning('Discarding compressed data: %s', e)
+            return None
+    
+    def _receivedAcknowledgement(self, sequenceNumber, t):
+        self.receivedAcknowledgements.put((sequenceNumber, t), False)
     
     def _processAcknowledgements(self):
         while True:
             try:
-                sequenceNumber = self.receivedAcknowledgements.get(False)
+                sequenceNumber, t = self.receivedAcknowledgements.get(False)
             except queue.Empty:
                 break
             else:
-                correct = False
-                for tmsg in self.outgoingMessages:
-                    if tmsg.sequenceNumber == sequenceNumber:
-                        self.outgoingMessages.remove(tmsg)
-                        correct = True
-                        break
-                if correct:
+                tmsg = self.outgoingMessages.pop(sequenceNumber, None)
+                self.deltaEncoder.acknowledged(sequenceNumber)
+                stream = self._streamParts.pop(sequenceNumber, None)
+                if stream:
+                    stream.inFlight -= 1
+                if tmsg:
                     logger.debug('Received correct Ack: %s', sequenceNumber)
+                    if self.congestionControl:
+                        self.congestionControl.onAck(tmsg.size)
+                    rtt = t - tmsg.lastSendAttempt
+                    if tmsg.sendAttempts == 1:
+                        # only unambiguous samples (Karn's algorithm)
+                        self.rttEstimator += rtt
+                    elif self.rttEstimator.srtt is not None and rtt < self.rttEstimator.srtt / 2:
+                        # too fast to answer the last transmission, an earlier one arrived
+                        self.spuriousRetransmits += 1
                 else:
                     logger.debug('Could not process Ack: %s', sequenceNumber)
     
-    @property
-    def outgoingPackets(self):
-        buf = b''
-        size = 0
-        
-        mtu1 = self.endpoint.mtu
-        mtu2 = self.endpoint.mtu - 25 # overhead = 13 Transport + 12 TMessageStart/Part
-        
-        # new messages
+    def _splitMessage(self, tmsg):
+        """Returns an OutgoingStream of the data of tmsg,
+        which is sent in reliable TMessageStart/TMessagePart chunks fitting in the MTU"""
+        mtu = self.endpoint.mtu - 25 # overhead = 13 Transport + 12 TMessageStart/Part
+        data = tmsg.payload
+        compressed = False
+        if self.compression and self.compression.sending and len(data) >= self.endpoint.compressionThreshold:
+            # the TCompressed message of data is split instead
+            payload = self.compression.payload(data)
+            compressed = payload is not data
+            data = payload
+        stream = OutgoingStream((data,), len(data), mtu)
+        stream.compressed = compressed
+        stream.priority = tmsg.priority
+        if tmsg.channelID is not None:
+            stream.setChannel(tmsg.channelID, tmsg.channelSequence)
+        return stream
+    
+    def _nextStreamPart(self, stream):
+        """Returns the next part of stream as TransportMessage, None if all are sent"""
+        if stream.pending:
+            tmsg = stream.pending
+            stream.pending = None
+            return tmsg
+        if stream.splitMessageNumber is None:
+            stream.splitMessageNumber = self.endpoint.nextSplitMessageNumber
+        try:
+            data = stream.next()
+        except (OSError, ValueError) as e:
+            # the receiver evicts the incomplete message
+            logger.error('Aborting %s: %s', stream, e)
+            stream.part = stream.parts
+            return None
+        if data is None:
+            return None
+        factory = self.endpoint.messageFactory
+        if stream.part == 1:
+            msg = factory.getByName('TMessageStart')(parts=stream.parts, data=data,
+                splitMessageNumber=stream.splitMessageNumber)
+        else:
+            msg = factory.getByName('TMessagePart')(part=stream.part - 1, data=data,
+                splitMessageNumber=stream.splitMessageNumber)
+        tmsg = TransportMessage(msg, self.nextOutgoingSequenceNumber, priority=stream.priority)
+        if stream.part == 1 and stream.channelID is not None:
+            tmsg.setChannel(stream.channelID, stream.channelSequence)
+        # encode now, data is only valid until the next part is cut
+        if self.compact:
+            tmsg.compact = True
+            tmsg.compactPayload
+        else:
+            tmsg.payload
+        tmsg.compressible = not stream.compressed
+        return tmsg
+    
+    def _clearOutgoing(self):
+        self.outgoingMessages.clear()
+        self.streams.clear()
+        self._streamParts.clear()
+    
+    def _takeNewMessages(self):
+        """Moves the messages sent since the last call to the scheduler (and streams)"""
         while True:
             try:
                 tmsg = self.newMessages.get(False)
             except queue.Empty:
-                break
+                return
+            if isinstance(tmsg, OutgoingStream):
+                self.streams.append(tmsg)
             else:
-                l = len(tmsg.bytes)
-                if l > mtu1:
-                    # Message is bigger than MTU, it might get fragmented
-                    # and lost, so we send it in chunks, which we send reliable
-                    data = tmsg.msg._bytes
-                    # Split data in chunks
-                    parts = [data[i:i+mtu2] for i in range(0, len(data), mtu2)]
-                    splitMessageNumber = self.endpoint.nextSplitMessageNumber
-                    msg = self.endpoint.messageFactory.getByName('TMessageStart')(
-                        parts=len(parts), data=parts.pop(0), splitMessageNumber=splitMessageNumber)
-                    tmsg = TransportMessage(msg, self.endpoint.nextOutgoingSequenceNumber)
-                    self.outgoingMessages.append(copy.deepcopy(tmsg))
-                    Msg = self.endpoint.messageFactory.getByName('TMessagePart')
-                    for i in range(1, len(parts)+1):
-                        msg = Msg(part=i, data=parts.pop(0), splitMessageNumber=splitMessageNumber)
-                        tmsg = TransportMessage(msg, self.endpoint.nextOutgoingSequenceNumber)
-                        self.outgoingMessages.append(copy.deepcopy(tmsg))
-                else:
-                    self.outgoingMessages.append(tmsg)
-        
-        # messages in outgoing buffer
-        sentMessages = []
+                self.scheduler.put(tmsg)
+    
+    def _dueMessages(self):
+        """Yields the TransportMessages, which have to be sent now: by priority, the due
+        retransmissions, new messages and stream parts of a priority before the next one.
+        Once new messages wait for the congestion window, only the retransmissions of the
+        lower priorities follow, their acknowledgements are what makes room in it.
+        Reliable messages are kept in outgoingMessages until they are acknowledged,
+        unreliable messages are dropped as soon as they are sent (or their deadline passed)."""
         t = time()
-        for tmsg in self.outgoingMessages:
-            if tmsg.lastSendAttempt + self.pingSampler.average >= t:
-                # msg cant be sent, we are waiting for acknowledgement
+        cc = self.congestionControl
+        self._takeNewMessages()
+        
+        # messages waiting for acknowledgement, which are due
+        retransmits = [[] for priority in range(PRIORITIES)]
+        for tmsg in list(self.outgoingMessages.values()):
+            if self._retransmitTime(tmsg) < t:
+                retransmits[tmsg.priority].append(tmsg)
+        
+        blocked = False
+        for priority in range(PRIORITIES):
+            for tmsg in retransmits[priority]:
+                if cc:
+                    if not cc.allow(tmsg.size, t):
+                        # out of tokens, nothing else can be sent either
+                        return
+                    cc.onLoss(t, self.rttEstimator.rto)
+                tmsg.lastSendAttempt = t
+                tmsg.sendAttempts += 1
+                self.retransmits += 1
+                yield tmsg
+            
+            if not blocked:
+                blocked = yield from self._dueNewMessages(priority, t)
+    
+    def _dueNewMessages(self, priority, t):
+        """Yields the new messages and stream parts of priority, which can be sent,
+        returns True if congestion control blocked sending"""
+        cc = self.congestionControl
+        scheduler = self.scheduler
+        
+        # new messages
+        while True:
+            tmsg = scheduler.next(priority, t)
+            if tmsg is None:
+                break
+            if (tmsg.msg.msgDelta and not tmsg.reliable and not tmsg.delta and self.protocol >= 5
+                    and tmsg.size <= self.maxMessageSize):
+                self.deltaEncoder.encode(tmsg, self.maxMessageSize)
+            if tmsg.size > self.maxMessageSize:
+                # Message is bigger than MTU, it might get fragmented
+                # and lost, so we send it in chunks, which we send reliable
+                self.streams.append(self._splitMessage(tmsg))
                 continue
+            if cc and not cc.allow(tmsg.size, t, new=tmsg.reliable):
+                # try again with the next update
+                scheduler.putBack(tmsg)
+                return True
             tmsg.lastSendAttempt = t
-            l = len(tmsg.bytes)
-            if size + l >= mtu1:
-                # message doesnt fit in packet
-                # send the packet
-                yield buf
-                # make new buffer
-                buf = b''
-                size = 0
-            # append message to buffer
-            buf += tmsg.bytes
-            size += l
-            self.endpoint.messagesOut += 1
-            if not tmsg.reliable:
-                sentMessages.append(tmsg)
+            tmsg.sendAttempts = 1
+            if tmsg.reliable:
+                self.outgoingMessages[tmsg.sequenceNumber] = tmsg
+            scheduler.sent[priority] += 1
+            yield tmsg
+        
+        # parts of split messages and streams, cut when there is room in their window
+        window = self.endpoint.streamWindow
+        for stream in [stream for stream in self.streams if stream.priority == priority]:
+            while stream.inFlight < window:
+                tmsg = self._nextStreamPart(stream)
+                if tmsg is None:
+                    break
+                if cc and not cc.allow(tmsg.size, t, new=True):
+                    stream.pending = tmsg
+                    return True
+                tmsg.lastSendAttempt = t
+                tmsg.sendAttempts = 1
+                self.outgoingMessages[tmsg.sequenceNumber] = tmsg
+                self._streamParts[tmsg.sequenceNumber] = stream
+                stream.inFlight += 1
+                yield tmsg
+            if stream.done:
+                self.streams.remove(stream)
+        return False
+    
+    @property
+    def maxMessageSize(self):
+        """Messages larger than this are split"""
+        if self.compact:
+            return self.endpoint.mtu - _compactOverhead
+        return self.endpoint.mtu
+    
+    def _retransmitTime(self, tmsg):
+        """Returns the time after which an unacknowledged message is sent again"""
+        return tmsg.lastSendAttempt + self.rttEstimator.backoff(tmsg.sendAttempts)
+    
+    def nextDeadline(self):
+        """Returns the time, when update or outgoingPackets have work to do next"""
+        deadlines = []
+        if not self.pendingDisconnect:
+            deadlines.append(self.lastPingTime + self.endpoint.pingInterval)
+            if self.lastReceiveTime:
+                deadlines.append(self.lastReceiveTime + self.endpoint.timeout)
+        retransmit = min((self._retransmitTime(tmsg) for tmsg in list(self.outgoingMessages.values())), default=None)
+        if retransmit is not None:
+            deadlines.append(retransmit)
+        if self.congestionControl:
+            # paced messages (messages waiting for the window are sent on acknowledgements)
+            first = self.scheduler.first()
+            if first is None and self.streams and self.streams[0].pending:
+                first = self.streams[0].pending
+            if first is not None:
+                paced = self.congestionControl.nextSendTime(first.size)
+                if paced is not None:
+                    deadlines.append(paced)
+        return min(deadlines) if deadlines else None
+    
+    @property
+    def outgoingPackets(self):
+        """Yields the packets to send as memoryviews into a buffer, which is
+        reused for the next packet, so they have to be sent right away"""
+        mtu = self.endpoint.mtu
+        if len(self._packetBuffer) != mtu:
+            self._packetBuffer = bytearray(mtu)
+        buf = self._packetBuffer
+        size = 0
+        compressible = True
+        # sequenceNumber of the compact packet, None for other packets
+        base = None
         
-        if buf:
-            yield buf
+        for tmsg in self._dueMessages():
+            if tmsg.compact:
+                if size and base is None:
+                    yield self._packet(buf, size, compressible)
+                    size = 0
+                    compressible = True
+                if size and size + tmsg.compactSize(base) > mtu:
+                    yield self._packet(buf, size, compressible)
+                    size = 0
+                    compressible = True
+                if not size:
+                    base = tmsg.sequenceNumber
+                    header = encodeVarint(base)
+                    buf[0] = COMPACT_PACKET
+                    size = 1 + len(header)
+                    buf[1:size] = header
+                size = tmsg.writeCompact(buf, size, base)
+            else:
+                # protocols before 6 and messages queued before connecting
+                if size and (base is not None or size + tmsg.size >= mtu):
+                    # message doesnt fit in packet
+                    # send the packet
+                    yield self._packet(buf, size, compressible)
+                    size = 0
+                    compressible = True
+                base = None
+                # append message to buffer
+                size = tmsg.writeInto(buf, size)
+            compressible = compressible and tmsg.compressible
+            self.endpoint.messagesOut += 1
         
-        for tmsg in sentMessages:
-            self.outgoingMessages.remove(tmsg)
+        if size:
+            yield self._packet(buf, size, compressible)
+    
+    def _packet(self, buf, size, compressible):
+        packet = memoryview(buf)[:size]
+        if compressible and self.compression and self.compression.sending and size >= self.endpoint.compressionThreshold:
+            return self.compression.packet(packet)
+        return packet
     
     def update(self):
         self._processAcknowledgements()
+        self._flushAcknowledgements()
         if self.pendingDisconnect:
             return
         t = time()
+        self.reassembler.evict(t)
         if t > self.lastPingTime + self.endpoint.pingInterval:
             self.lastPingNumber += 1
             self.lastPingTime = t
@@ -511,7 +1123,7 @@ class Peer(object):
         elif t > self.lastReceiveTime + self.endpoint.timeout:
             self.pendingDisconnect = True
             # reliable messages will not get acknowledged, so remove all
-            self.outgoingMessages.clear()
+            self._clearOutgoing()
             self.endpoint._peerTimeout(self)
     
     def __repr__(self):
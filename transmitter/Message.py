@@ -1,53 +1,87 @@
 import struct
+from time import time
 from transmitter.BitField import BitField
+from transmitter.MessageCodec import MessageCodec
+from transmitter.ByteBuffer import ByteBuffer, encodeVarint, zigzag
+from transmitter.Channel import CHANNELS
+from transmitter.Scheduler import HIGH, NORMAL, PRIORITIES
 
 import logging
 logger = logging.getLogger(__name__)
 
-class Message(object):
+class MessageType(type):
+    """Gives every Message class __slots__ for the fields in its msgData,
+    so every instance stores its own values and reads them as plain attributes.
+    msgData itself stays the (class-level) declaration of types and defaults."""
+    def __new__(mcs, name, bases, namespace):
+        inherited = set()
+        for base in bases:
+            for clas in base.__mro__:
+                inherited.update(clas.__dict__.get('__slots__', ()))
+        slots = list(namespace.get('__slots__', ()))
+        slots.extend(key for key in sorted(namespace.get('msgData', {})) if key not in inherited and key not in slots)
+        namespace['__slots__'] = tuple(slots)
+        return super().__new__(mcs, name, bases, namespace)
+    
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        # data have to be accessed sorted, because sender and receiver have to know the order of the keys
+        cls._fields = tuple(sorted(cls.msgData))
+        cls._defaults = tuple(cls.msgData[key][1] for key in cls._fields)
+
+class Message(object, metaclass=MessageType):
     """A Message is a packet of data which can be sent over the network.
     Every Message has a unique msgID and usually some fields of data of a special type and a default value.
     Custom Messages have a msgID >= 0."""
     ###########################################################################
-    # ONLY set these 4 attributes in class definition, as they are defaults
+    # ONLY set these attributes in class definition, as they are defaults
     # Use normal API to modify message instances
     msgID = 0
     msgReliable = False
     msgOrdered = False
+    # channel (0-127) the messages are ordered in (see Channel), ordered messages without one use 0
+    msgChannel = None
+    # messages of a higher priority (HIGH, NORMAL, LOW of Scheduler) are sent first,
+    # unreliable messages, which could not be sent within msgLifetime seconds, are dropped
+    msgPriority = NORMAL
+    msgLifetime = None
     msgData = {
         #'name': ('type', '(default)value')
     }
+    # send (unreliable) messages as changes against the version the peer acknowledged last,
+    # msgDeltaKey names a field identifying the object, which the messages are versions of
+    msgDelta = False
+    msgDeltaKey = None
+    # keep only the newest (unreliable) message of the class, which is not sent yet,
+    # per value of the field msgCoalesceKey (if given), older ones are not sent anymore
+    msgCoalesce = False
+    msgCoalesceKey = None
     ###########################################################################
     
     # cache bytes
-    _bytesCached = b''
+    __slots__ = ('_bytesCached',)
     _factory = None
+    # received bytes fields are memoryviews into the received data instead of copies,
+    # only valid while the message is processed (for messages handled by the endpoint itself)
+    _viewBytes = False
     
     def __init__(self, **data):
+        setValue = object.__setattr__
+        for key, value in zip(self._fields, self._defaults):
+            setValue(self, key, value)
+        setValue(self, '_bytesCached', b'')
         for key, value in data.items():
             self.__setattr__(key, value)
     
-    def __getattr__(self, name):
-        try:
-            return self.msgData[name][1]
-        except KeyError:
-            return super().__getattr__(name)
-    
     def __setattr__(self, name, value):
-        try:
-            t, v = self.msgData[name]
-        except KeyError:
-            super().__setattr__(name, value)
-        else:
-            self._emptyCache()
-            self.msgData[name] = (t, value)
+        object.__setattr__(self, name, value)
+        if name != '_bytesCached':
+            object.__setattr__(self, '_bytesCached', b'')
     
     def _items(self):
-        """Provides iterator access to msgData in sorted key order"""
-        # data have to be accessed sorted, because dict's key order is undefined !!
-        # But sender and receiver have to know the order of the keys
-        for key in sorted(list(self.msgData.keys())):
-            yield key, self.msgData[key]
+        """Provides iterator access to the fields (name, (type, value)) in sorted key order"""
+        for key in self._fields:
+            yield key, (self.msgData[key][0], getattr(self, key))
     
     @property
     def _bytes(self):
@@ -58,43 +92,31 @@ class Message(object):
     def _emptyCache(self):
         self._bytesCached = b''
     
-    def _getBytes(self):
-        format = '!l'
-        values = [self.msgID]
-        for k, v in self._items():
-            t = v[0]
-            v = v[1]
-            if t == 'int':      format += 'l'
-            elif t == 'float':  format += 'f'
-            elif t in ('str', 'bytes'):
-                if t == 'str':
-                    v = v.encode()
-                format += 'L'
-                values.append(len(v))
-                format += str(len(v)) + 's'
-            elif t == 'bool':   format += '?'
-            else:
-                logger.error('Cant encode message key of unknown type', t)
-                raise TypeError("type '{}' unknown".format(t))
-            values.append(v)
-        return struct.pack(format, *values)
+    @classmethod
+    def _getCodec(cls, compact=False):
+        """Returns the compiled wire layout of this class (compiled on first use)"""
+        name = '_compactCodec' if compact else '_codec'
+        try:
+            return cls.__dict__[name]
+        except KeyError:
+            codec = MessageCodec(cls, compact=compact)
+            setattr(cls, name, codec)
+            return codec
+    
+    def _getBytes(self, compact=False):
+        codec = self._getCodec(compact)
+        return codec.encode(codec.values(self))
     
-    def _readFromByteBuffer(self, byteBuffer):
+    def _readFromByteBuffer(self, byteBuffer, compact=False):
         # msgID is read by factory
-        for k, v in self._items():
-            t = v[0]
-            if t == 'int':      self.__setattr__(k, byteBuffer.readStruct('l')[0])
-            elif t == 'float':  self.__setattr__(k, byteBuffer.readStruct('f')[0])
-            elif t in ('str', 'bytes'):
-                length = byteBuffer.readStruct('L')[0]
-                data = byteBuffer.readStruct(str(length) + 's')[0]
-                if t == 'str':
-                    data = data.decode()
-                self.__setattr__(k, data)
-            elif t == 'bool':   self.__setattr__(k, byteBuffer.readStruct('?')[0])
-            else:
-                logger.error('Cant decode message key of unknown type %s', t)
-                raise TypeError("type '{}' unknown".format(t))
+        codec = self._getCodec(compact)
+        self._setValues(codec.names, codec.decode(byteBuffer))
+    
+    def _setValues(self, names, values):
+        setValue = object.__setattr__
+        for name, value in zip(names, values):
+            setValue(self, name, value)
+        setValue(self, '_bytesCached', b'')
     
     def __eq__(self, name):
         try:
@@ -108,8 +130,9 @@ class Message(object):
     
     def __deepcopy__(self, memodict={}):
         msg = self.__class__()
-        msg.msgData = self.msgData.copy()
-        msg._factory = self._factory
+        for key in self._fields:
+            object.__setattr__(msg, key, getattr(self, key))
+        object.__setattr__(msg, '_bytesCached', self._bytesCached)
         return msg
 
 class MessageFactory(object):
@@ -130,6 +153,10 @@ class MessageFactory(object):
             TTimeout,
             TMessageStart,
             TMessagePart,
+            TAcknowledgements32,
+            TCompression,
+            TCompressed,
+            TAcknowledgements,
             )
     
     def add(self, *classes):
@@ -142,6 +169,8 @@ class MessageFactory(object):
                 raise ValueError('class {} or id {} already exists!'.format(clas.__name__, clas.msgID))
             # give the class the factory, so the message can perform .isA()
             clas._factory = self
+            # compile the wire layout once, instead of on every encode/decode
+            clas._codec = MessageCodec(clas)
             self.messagesByID[clas.msgID] = clas
             self.messagesByName[clas.__name__] = clas
             logger.info('Added message type to factory (%s, %s)', clas.__name__, clas.msgID)
@@ -160,32 +189,178 @@ class MessageFactory(object):
             logger.error('Cant find message with name %s', name)
             raise KeyError("Message name '{}' not found".format(name))
     
+    def fromBytes(self, data):
+        """Returns a new message read from data (as returned by Message._bytes)"""
+        byteBuffer = ByteBuffer(data)
+        msg = self.getByID(byteBuffer.readStruct('l')[0])()
+        msg._readFromByteBuffer(byteBuffer)
+        return msg
+    
     def isA(self, message, name):
         return isinstance(message, self.getByName(name))
 
 class TransportMessage(object):
     """Wrapper for a Message. Stores transport related information."""
+    # sequenceNumber, flags
+    header = struct.Struct('!QB')
+    # whether packets with this message are worth compressing
+    compressible = True
+    # sent in compact packets (protocol 6, see compactPayload)
+    compact = False
+    
     def __init__(self, msg, sequenceNumber=0, **flags):
         self.msg = msg
         self.flags = BitField()
         self.reliable = flags.get('reliable', self.msg.msgReliable)
         self.ordered = flags.get('ordered', self.msg.msgOrdered)
+        # see Channel, the peer numbers the messages of each channel
+        self.channel = flags.get('channel', self.msg.msgChannel)
+        if self.channel is None and self.ordered:
+            self.channel = 0
+        elif self.channel is not None:
+            if not 0 <= self.channel < CHANNELS:
+                raise ValueError('channel must be in range(0, {})'.format(CHANNELS))
+            self.ordered = True
+        self.channelID = None
+        self.channelSequence = 0
+        self._channelHeader = b''
+        self.priority = flags.get('priority', self.msg.msgPriority)
+        if not 0 <= self.priority < PRIORITIES:
+            raise ValueError('priority must be in range(0, {})'.format(PRIORITIES))
+        lifetime = flags.get('lifetime', self.msg.msgLifetime)
+        # time after which it is not sent anymore (if unreliable)
+        self.deadline = time() + lifetime if lifetime is not None else None
+        # messages with the same key replace each other until they are sent (see Scheduler)
+        self.coalesceKey = None
+        if not self.reliable:
+            key = flags.get('coalesce')
+            if key is not None:
+                self.coalesceKey = (self.msg.msgID, key)
+            elif self.msg.msgCoalesce:
+                self.coalesceKey = (self.msg.msgID,
+                    getattr(self.msg, self.msg.msgCoalesceKey) if self.msg.msgCoalesceKey else None)
         self.sequenceNumber = sequenceNumber
         self.lastSendAttempt = 0
+        self.sendAttempts = 0
+        self._payload = None
+        self._compactPayload = None
+        self._values = None
         self._cache = b''
+        # (base, header) of the last compactSize, see compactHeader
+        self._compactHeader = None
+    
+    @property
+    def payload(self):
+        """The encoded msg, captured once and shared with the copies for other peers"""
+        if self._payload is None:
+            self._payload = self.msg._bytes
+        return self._payload
+    
+    @property
+    def compactPayload(self):
+        """The msg in the compact layout (varint msgID and lengths), shared like payload"""
+        if self._compactPayload is None:
+            self._compactPayload = self.msg._getBytes(True)
+        return self._compactPayload
+    
+    @property
+    def values(self):
+        """The field values of msg as captured in payload, so they do not change with msg
+        (compared by the DeltaEncoder), shared like payload"""
+        if self._values is None:
+            if self._payload is None and self._compactPayload is not None:
+                # captured for compact peers only
+                byteBuffer = ByteBuffer(self._compactPayload)
+                byteBuffer.readVarint()
+                self._values = self.msg._getCodec(True).decode(byteBuffer)
+            else:
+                byteBuffer = ByteBuffer(self.payload)
+                byteBuffer.readStruct('l')
+                self._values = self.msg._getCodec().decode(byteBuffer)
+        return self._values
+    
+    def copy(self, sequenceNumber, compact=False):
+        """Returns a TransportMessage with the same msg, flags and payload,
+        only the transport information (sequenceNumber, send attempts) is its own.
+        A compact copy only encodes the compactPayload, unless payload was encoded already"""
+        tmsg = TransportMessage(self.msg, sequenceNumber)
+        tmsg.flags = BitField(int(self.flags))
+        tmsg.channel = self.channel
+        tmsg.priority = self.priority
+        tmsg.deadline = self.deadline
+        tmsg.coalesceKey = self.coalesceKey
+        if compact:
+            tmsg.compact = True
+            tmsg._compactPayload = self.compactPayload
+            tmsg._payload = self._payload
+        else:
+            tmsg._payload = self.payload
+        if self.msg.msgDelta:
+            tmsg._values = self.values
+        return tmsg
     
     @property
     def bytes(self):
         if not self._cache:
-            self._cache = struct.pack('!QB', self.sequenceNumber, self.flags) + self.msg._bytes
+            self._cache = self.header.pack(self.sequenceNumber, self.flags) + self.payload
         return self._cache
     
+    @property
+    def size(self):
+        if self.compact:
+            # a one byte sequenceNumber difference, see compactSize
+            return 2 + len(self._channelHeader) + len(self.compactPayload)
+        return self.header.size + len(self.payload)
+    
+    def writeInto(self, buf, offset):
+        """Writes the message into buf at offset, returns the offset after it"""
+        self.header.pack_into(buf, offset, self.sequenceNumber, self.flags)
+        offset += self.header.size
+        data = self.payload
+        end = offset + len(data)
+        buf[offset:end] = data
+        return end
+    
+    def compactHeader(self, base):
+        """Returns the sequenceNumber relative to base, the flags and the channel header,
+        encoded once for the packet being built (compactSize, then writeCompact)"""
+        cached = self._compactHeader
+        if cached is not None and cached[0] == base:
+            return cached[1]
+        header = b''.join((encodeVarint(zigzag(self.sequenceNumber - base)), bytes((int(self.flags),)), self._channelHeader))
+        self._compactHeader = (base, header)
+        return header
+    
+    def compactSize(self, base):
+        return len(self.compactHeader(base)) + len(self.compactPayload)
+    
+    def writeCompact(self, buf, offset, base):
+        """Writes the message into a compact packet at offset, returns the offset after it.
+        Its sequenceNumber is written relative to base, the sequenceNumber of the packet"""
+        header = self.compactHeader(base)
+        end = offset + len(header)
+        buf[offset:end] = header
+        offset = end
+        data = self.compactPayload
+        end = offset + len(data)
+        buf[offset:end] = data
+        return end
+    
+    def setChannel(self, channelID, sequence):
+        """Sends the message as number sequence of the channel channelID (in compact packets only)"""
+        self.channelID = channelID
+        self.channelSequence = sequence
+        self._channelHeader = bytes((channelID,)) + encodeVarint(sequence)
+        self._compactHeader = None
+        self.flags[3] = True
+    
     @property
     def reliable(self):
         return self.flags[0]
     @reliable.setter
     def reliable(self, value):
         self._cache = b''
+        self._compactHeader = None
         self.flags[0] = value
     
     @property
@@ -194,20 +369,34 @@ class TransportMessage(object):
     @ordered.setter
     def ordered(self, value):
         self._cache = b''
+        self._compactHeader = None
         self.flags[1] = value
     
+    @property
+    def delta(self):
+        """The payload is delta encoded (see DeltaEncoder), it is acknowledged like reliable messages"""
+        return self.flags[2]
+    @delta.setter
+    def delta(self, value):
+        self._cache = b''
+        self._compactHeader = None
+        self.flags[2] = value
+    
     def __repr__(self):
         return '<TransportMessage seqN={} flags={} msg={}>'.format(self.sequenceNumber, self.flags, self.msg)
 
 class TConnect(Message):
     msgID = -1
+    msgPriority = HIGH
 
 class TDisconnect(Message):
     msgID = -2
+    msgPriority = HIGH
     msgReliable = True
 
 class TConnectRequest(Message):
     msgID = -3
+    msgPriority = HIGH
     msgReliable = True
     msgData = {
         'protocol': ('int', 0)
@@ -215,26 +404,31 @@ class TConnectRequest(Message):
 
 class TConnectRequestAccepted(Message):
     msgID = -4
+    msgPriority = HIGH
     msgReliable = True
 
 class TConnectRequestRejected(Message):
     msgID = -5
+    msgPriority = HIGH
     msgReliable = True
 
 class TAcknowledgement(Message):
     msgID = -6
+    msgPriority = HIGH
     msgData = {
         'sequenceNumber': ('int', 0)
     }
 
 class TPing(Message):
     msgID = -7
+    msgPriority = HIGH
     msgData = {
         'pingNumber': ('int', 0)
     }
 
 class TPong(Message):
     msgID = -8
+    msgPriority = HIGH
     msgData = {
         'pingNumber': ('int', 0)
     }
@@ -245,6 +439,7 @@ class TTimeout(Message):
 class TMessageStart(Message):
     msgID = -10
     msgReliable = True
+    _viewBytes = True
     msgData = {
         'splitMessageNumber': ('int', 0),
         'parts': ('int', 0),
@@ -254,8 +449,48 @@ class TMessageStart(Message):
 class TMessagePart(Message):
     msgID = -11
     msgReliable = True
+    _viewBytes = True
     msgData = {
         'splitMessageNumber': ('int', 0),
         'part': ('int', 0),
         'data': ('bytes', b'')
     }
+
+class TAcknowledgements32(Message):
+    """TAcknowledgements of protocols 3 to 7, with a 32 bit sequenceNumber"""
+    msgID = -12
+    msgPriority = HIGH
+    msgData = {
+        'sequenceNumber': ('uint32', 0),
+        'mask': ('bytes', b'')
+    }
+
+class TCompression(Message):
+    """Offers (server) or accepts (client) compression, algorithm is empty to decline.
+    dictionary identifies the preset dictionary (empty: none)"""
+    msgID = -13
+    msgPriority = HIGH
+    msgReliable = True
+    msgData = {
+        'algorithm': ('str', ''),
+        'dictionary': ('bytes', b'')
+    }
+
+class TCompressed(Message):
+    """Compressed messages (of a packet) or the compressed payload of a split message"""
+    msgID = -14
+    _viewBytes = True
+    msgData = {
+        'data': ('bytes', b''),
+        'dictionary': ('bool', False)
+    }
+
+class TAcknowledgements(Message):
+    """Acknowledges sequenceNumber and every sequenceNumber - n,
+    where bit n-1 of mask (little endian) is set"""
+    msgID = -15
+    msgPriority = HIGH
+    msgData = {
+        'sequenceNumber': ('varint', 0),
+        'mask': ('bytes', b'')
+    }
\ No newline at end of file
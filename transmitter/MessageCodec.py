@@ -0,0 +1,409 @@
+import sys
+import array
+import struct
+import operator
+import itertools
+from transmitter.ByteBuffer import encodeVarint, zigzag, unzigzag
+
+import logging
+logger = logging.getLogger(__name__)
+
+# elements of array fields ('array:f4', or 'array:f4[3]' for arrays of 3 floats)
+ARRAY_ELEMENTS = {
+    'i8': 'b',
+    'u8': 'B',
+    'i16': 'h',
+    'u16': 'H',
+    'i32': 'i',
+    'u32': 'I',
+    'i64': 'q',
+    'u64': 'Q',
+    'f4': 'f',
+    'f8': 'd',
+}
+# arrays are sent little endian, so they are copied as they are on most machines
+_swap = sys.byteorder != 'little'
+
+def arrayType(t):
+    """Returns (format, shape of an element) of an array field type, None for other types"""
+    if not t.startswith('array:'):
+        return None
+    element, bracket, shape = t[6:].partition('[')
+    if element not in ARRAY_ELEMENTS or (bracket and not shape.endswith(']')):
+        return None
+    try:
+        shape = tuple(int(n) for n in shape[:-1].split(',')) if bracket else ()
+    except ValueError:
+        return None
+    if any(n < 1 for n in shape):
+        return None
+    return ARRAY_ELEMENTS[element], shape
+
+def _kind(format):
+    return 'f' if format in 'fd' else 'u' if format.isupper() else 'i'
+
+def _arrayData(value, format, shape):
+    """Returns the data of an array field value (a memoryview of its buffer, if it can be sent as it is).
+    value is a buffer (array.array, numpy array, ...) or a sequence of numbers, bytes are sent unchanged"""
+    try:
+        view = memoryview(value)
+    except TypeError:
+        view = memoryview(array.array(format, value))
+    if view.format != 'B':
+        native = view.format.lstrip('@=<>!')
+        if native not in 'bBhHiIlLqQfd' or view.itemsize != struct.calcsize(format) or _kind(native) != _kind(format):
+            raise TypeError("array of '{}' can not be sent as '{}'".format(view.format, format))
+        if not view.c_contiguous:
+            raise ValueError('array is not contiguous')
+        littleEndian = view.format[0] == '<' or (view.format[0] not in '>!' and not _swap)
+        if not littleEndian:
+            swapped = array.array(format, view.tobytes())
+            swapped.byteswap()
+            view = memoryview(swapped)
+        try:
+            view = view.cast('B')
+        except TypeError:
+            # only native formats can be cast
+            view = memoryview(view.tobytes())
+    size = struct.calcsize(format)
+    for n in shape:
+        size *= n
+    if len(view) % size:
+        raise ValueError('array of {} bytes is no multiple of its {} byte elements'.format(len(view), size))
+    return view
+
+def _arrayView(data, format, shape):
+    """Returns a memoryview of the array in data, shaped (number of elements,) + shape"""
+    size = struct.calcsize(format)
+    for n in shape:
+        size *= n
+    if len(data) % size:
+        raise ValueError('array of {} bytes is no multiple of its {} byte elements'.format(len(data), size))
+    if _swap:
+        swapped = array.array(format, data)
+        swapped.byteswap()
+        data = swapped.tobytes()
+    view = memoryview(data)
+    if shape and len(view):
+        return view.cast(format, (len(view) // size,) + shape)
+    return view.cast(format)
+
+class _Nested(object):
+    """A field of type 'msg:<name>', a message of the class registered under name
+    in the MessageFactory of the message. It is encoded with its fields only
+    (its class is known), None stands for a message with the defaults."""
+    def __init__(self, name, owner, compact):
+        self.name = name
+        self.owner = owner
+        self.compact = compact
+        self.clas = None
+        self.codec = None
+    
+    def _resolve(self):
+        factory = self.owner._factory
+        if factory is None:
+            raise TypeError("{} has to be added to a MessageFactory for its field of message '{}'".format(
+                self.owner.__name__, self.name))
+        clas = factory.getByName(self.name)
+        self.codec = clas._getCodec(self.compact).subset(range(len(clas._fields)))
+        # the slots of the fields (in layout order), to build many messages fast
+        self.setters = [getattr(clas, name).__set__ for name in self.codec.names + ['_bytesCached']]
+        self.clas = clas
+    
+    def encode(self, msg, chunks):
+        if self.codec is None:
+            self._resolve()
+        if msg is None:
+            msg = self.clas()
+        elif not isinstance(msg, self.clas):
+            raise TypeError('{} is no {}'.format(msg, self.name))
+        chunks.append(self.codec.encode(self.codec.values(msg)))
+    
+    def decode(self, byteBuffer):
+        if self.codec is None:
+            self._resolve()
+        msg = self.clas.__new__(self.clas)
+        msg._setValues(self.codec.names, self.codec.decode(byteBuffer))
+        return msg
+
+class _Repeated(object):
+    """A field of type 'list:<type>', a sequence of elements of type,
+    which is received as list. It is encoded as the number of elements
+    followed by the elements, fixed size elements (and messages of them)
+    are packed with one struct for all."""
+    _count = struct.Struct('!L')
+    
+    def __init__(self, t, owner, compact):
+        self.t = t
+        self.compact = compact
+        self.nested = _Nested(t[4:], owner, compact) if t.startswith('msg:') else None
+    
+    def _writeCount(self, n, chunks):
+        chunks.append(encodeVarint(n) if self.compact else self._count.pack(n))
+    
+    def encode(self, values, chunks):
+        t = self.t
+        n = len(values)
+        self._writeCount(n, chunks)
+        if t in MessageCodec.FIXED:
+            chunks.append(struct.pack('!{}{}'.format(n, MessageCodec.FIXED[t]), *values))
+        elif t == 'varint':
+            chunks.extend(encodeVarint(value) for value in values)
+        elif t == 'zigzag':
+            chunks.extend(encodeVarint(zigzag(value)) for value in values)
+        elif t in MessageCodec.VARIABLE:
+            for data in values:
+                if t == 'str':
+                    data = data.encode()
+                self._writeCount(len(data), chunks)
+                chunks.append(data)
+        else:
+            nested = self.nested
+            if nested.codec is None:
+                nested._resolve()
+            codec = nested.codec
+            if codec.simple and n:
+                # all fields of all messages in one struct
+                data = []
+                for msg in values:
+                    if not isinstance(msg, nested.clas):
+                        raise TypeError('{} is no {}'.format(msg, nested.name))
+                    data.extend(codec.values(msg))
+                chunks.append(struct.pack('!' + codec.encodeSegments[0][0].format[1:] * n, *data))
+            else:
+                for msg in values:
+                    nested.encode(msg, chunks)
+    
+    def decode(self, byteBuffer):
+        t = self.t
+        n = byteBuffer.readVarint() if self.compact else byteBuffer.unpack(self._count)[0]
+        if t in MessageCodec.FIXED:
+            return list(byteBuffer.unpack(struct.Struct('!{}{}'.format(n, MessageCodec.FIXED[t]))))
+        if t == 'varint':
+            return [byteBuffer.readVarint() for i in range(n)]
+        if t == 'zigzag':
+            return [unzigzag(byteBuffer.readVarint()) for i in range(n)]
+        if t in MessageCodec.VARIABLE:
+            values = []
+            for i in range(n):
+                length = byteBuffer.readVarint() if self.compact else byteBuffer.unpack(self._count)[0]
+                data = byteBuffer.readView(length)
+                values.append(str(data, 'utf-8') if t == 'str' else data.tobytes())
+            return values
+        nested = self.nested
+        if nested.codec is None:
+            nested._resolve()
+        codec = nested.codec
+        if codec.simple and n:
+            clas = nested.clas
+            new = clas.__new__
+            setters = nested.setters
+            data = iter(byteBuffer.unpack(struct.Struct('!' + codec.encodeSegments[0][0].format[1:] * n)))
+            values = []
+            for row in zip(*[data] * len(codec.names), itertools.repeat(b'')):
+                msg = new(clas)
+                for setter, value in zip(setters, row):
+                    setter(msg, value)
+                values.append(msg)
+            return values
+        return [nested.decode(byteBuffer) for i in range(n)]
+
+def compositeType(t, owner, compact=False):
+    """Returns the encoder of a field of type 'msg:<name>' or 'list:<type>', None for other types"""
+    if t.startswith('msg:') and t[4:].isidentifier():
+        return _Nested(t[4:], owner, compact)
+    if t.startswith('list:'):
+        element = t[5:]
+        if (element in MessageCodec.FIXED or element in MessageCodec.VARINTS or element in MessageCodec.VARIABLE
+                or (element.startswith('msg:') and element[4:].isidentifier())):
+            return _Repeated(element, owner, compact)
+    return None
+
+class _Placeholder(object):
+    """Stands for data of a known size, which is not encoded (see MessageCodec.encodeAround)"""
+    def __init__(self, size):
+        self.size = size
+    
+    def __len__(self):
+        return self.size
+
+class MessageCodec(object):
+    """The compiled wire layout of a Message class.
+    Fields are laid out in sorted key order. Every run of fixed size fields,
+    together with the length prefix of the str/bytes field following it,
+    is merged into one precompiled struct.Struct, so a message is encoded and
+    decoded with one pack/unpack per run instead of one per field.
+    The compact layout (protocol 6) has a zigzag varint msgID and varint length prefixes.
+    Array fields are length prefixed like bytes, their data is copied in and out as a whole.
+    Lists and nested messages (see _Repeated, _Nested) encode themselves after the run before them."""
+    
+    FIXED = {
+        'int': 'l',
+        'float': 'f',
+        'bool': '?',
+        'int8': 'b',
+        'int16': 'h',
+        'uint32': 'L',
+        'int64': 'q',
+        'double': 'd',
+    }
+    VARIABLE = ('str', 'bytes')
+    # unsigned and signed (zigzag) integers of any size as varints
+    VARINTS = ('varint', 'zigzag')
+    
+    def __init__(self, clas, names=None, compact=False):
+        self._clas = clas
+        self.msgID = clas.msgID
+        self.compact = compact
+        self.names = sorted(clas.msgData.keys()) if names is None else list(names)
+        self.types = [clas.msgData[name][0] for name in self.names]
+        # format and shape of array fields by type
+        self._arrays = {t: arrayType(t) for t in self.types if arrayType(t)}
+        # encoders of list and message fields by type
+        self._composites = {t: compositeType(t, clas, compact) for t in self.types if compositeType(t, clas, compact)}
+        # returns the values of a message (in layout order)
+        if len(self.names) > 1:
+            self.values = operator.attrgetter(*self.names)
+        elif self.names:
+            getter = operator.attrgetter(self.names[0])
+            self.values = lambda msg: (getter(msg),)
+        else:
+            self.values = lambda msg: ()
+        # a codec of some fields (see subset) encodes them without msgID
+        self._prefix = (self.msgID,) if names is None and not compact else ()
+        self._header = encodeVarint(zigzag(self.msgID)) if names is None and compact else b''
+        # segments: (struct or None, number of fixed values, type of variable field or None)
+        self.encodeSegments = self._compile('l' if self._prefix else '')
+        self.decodeSegments = self._compile('')
+        # bytes fields stay views into the received data (see Message._viewBytes)
+        self.viewBytes = clas._viewBytes
+        # messages without str/bytes/varint fields are packed by one struct
+        self.simple = len(self.encodeSegments) == 1 and self.encodeSegments[0][2] is None
+        # delta encoding (see Message.msgDelta): bitmask of the fields sent, the field always sent
+        self.maskSize = (len(self.names) + 7) // 8
+        self.deltaKey = self.names.index(clas.msgDeltaKey) if names is None and clas.msgDeltaKey else None
+        self._subsets = {}
+    
+    def _compile(self, header):
+        segments = []
+        format = header
+        count = 0
+        for t in self.types:
+            if t in self.FIXED:
+                format += self.FIXED[t]
+                count += 1
+            elif t in self.VARIABLE or t in self.VARINTS or t in self._arrays or t in self._composites:
+                if t not in self.VARINTS and t not in self._composites and not self.compact:
+                    format += 'L'
+                segments.append((struct.Struct('!' + format) if format else None, count, t))
+                format = ''
+                count = 0
+            else:
+                logger.error('Cant compile message key of unknown type %s', t)
+                raise TypeError("type '{}' unknown".format(t))
+        if format:
+            segments.append((struct.Struct('!' + format), count, None))
+        return segments
+    
+    def encode(self, values):
+        """Returns the bytes of msgID followed by values (in layout order)"""
+        if self.simple:
+            data = self.encodeSegments[0][0].pack(*self._prefix, *values)
+            return self._header + data if self._header else data
+        return b''.join(self._chunks(values))
+    
+    def encodeAround(self, values, name, size):
+        """Returns the bytes before and after the data of the bytes field name,
+        when it holds size bytes, which the caller puts in between"""
+        i = self.names.index(name)
+        if self.types[i] != 'bytes':
+            raise TypeError("field '{}' is not of type bytes".format(name))
+        placeholder = _Placeholder(size)
+        values = list(values)
+        values[i] = placeholder
+        chunks = self._chunks(values)
+        i = next(i for i, chunk in enumerate(chunks) if chunk is placeholder)
+        return b''.join(chunks[:i]), b''.join(chunks[i+1:])
+    
+    def _chunks(self, values):
+        chunks = [self._header] if self._header else []
+        args = list(self._prefix)
+        i = 0
+        for compiled, count, t in self.encodeSegments:
+            args.extend(values[i:i+count])
+            i += count
+            if t is None:
+                chunks.append(compiled.pack(*args))
+                continue
+            data = values[i]
+            i += 1
+            if t in self.VARINTS:
+                if compiled:
+                    chunks.append(compiled.pack(*args))
+                chunks.append(encodeVarint(zigzag(data) if t == 'zigzag' else data))
+            elif t in self._composites:
+                if compiled:
+                    chunks.append(compiled.pack(*args))
+                self._composites[t].encode(data, chunks)
+            else:
+                if t == 'str':
+                    data = data.encode()
+                elif t in self._arrays:
+                    data = _arrayData(data, *self._arrays[t])
+                if self.compact:
+                    if compiled:
+                        chunks.append(compiled.pack(*args))
+                    chunks.append(encodeVarint(len(data)))
+                else:
+                    args.append(len(data))
+                    chunks.append(compiled.pack(*args))
+                chunks.append(data)
+            args = []
+        return chunks
+    
+    def subset(self, indices):
+        """Returns the codec of the fields at indices (without msgID), compiled on first use"""
+        indices = tuple(indices)
+        try:
+            return self._subsets[indices]
+        except KeyError:
+            codec = self._subsets[indices] = MessageCodec(self._clas, [self.names[i] for i in indices], self.compact)
+            return codec
+    
+    def decode(self, byteBuffer):
+        """Reads the values (in layout order) from byteBuffer
+        msgID has to be read already"""
+        values = []
+        for compiled, count, t in self.decodeSegments:
+            unpacked = byteBuffer.unpack(compiled) if compiled else ()
+            if t is None:
+                values.extend(unpacked)
+            elif t in self.VARINTS:
+                values.extend(unpacked)
+                value = byteBuffer.readVarint()
+                values.append(unzigzag(value) if t == 'zigzag' else value)
+            elif t in self._composites:
+                values.extend(unpacked)
+                values.append(self._composites[t].decode(byteBuffer))
+            else:
+                if self.compact:
+                    values.extend(unpacked)
+                    length = byteBuffer.readVarint()
+                else:
+                    values.extend(unpacked[:-1])
+                    length = unpacked[-1]
+                # the only copy of the received data is the final value
+                data = byteBuffer.readView(length)
+                if t == 'str':
+                    values.append(str(data, 'utf-8'))
+                elif t in self._arrays:
+                    # the receive buffer is reused, so the array is copied unless bytes stay views
+                    values.append(_arrayView(data if self.viewBytes else data.tobytes(), *self._arrays[t]))
+                elif self.viewBytes:
+                    values.append(data)
+                else:
+                    values.append(data.tobytes())
+        return values
+    
+    def __repr__(self):
+        return '<MessageCodec msgID={} segments={}>'.format(self.msgID, len(self.encodeSegments))
@@ -0,0 +1,46 @@
+import socket
+import select
+
+class Notifier(object):
+    """A flag, which can be waited for with select.
+    set() may be called from any thread, fileno() can be added to
+    an existing select/poll loop."""
+    def __init__(self):
+        self._reader, self._writer = socket.socketpair()
+        self._reader.setblocking(False)
+        self._writer.setblocking(False)
+        self._set = False
+    
+    def fileno(self):
+        return self._reader.fileno()
+    
+    def set(self):
+        if not self._set:
+            self._set = True
+            try:
+                self._writer.send(b'\0')
+            except OSError:
+                # buffer full (it is set anyway) or closed
+                pass
+    
+    def clear(self):
+        """Call before handling the events which were notified,
+        so events which happen meanwhile set the flag again"""
+        try:
+            while self._reader.recv(4096):
+                pass
+        except OSError:
+            pass
+        self._set = False
+    
+    def wait(self, timeout=None):
+        """Returns True, if the flag is set, False after timeout seconds"""
+        readable, _, _ = select.select([self._reader], [], [], timeout)
+        return bool(readable)
+    
+    def close(self):
+        self._reader.close()
+        self._writer.close()
+    
+    def __repr__(self):
+        return '<Notifier set={}>'.format(self._set)
@@ -0,0 +1,92 @@
+import itertools
+from transmitter.Scheduler import NORMAL
+
+class OutgoingStream(object):
+    """The data of a message, which is sent in parts (TMessageStart, TMessagePart).
+    The parts are cut lazily from chunks (an iterable of bytes-like objects),
+    as memoryview slices where a part lies within one chunk, so the data never has
+    to be in memory at once. The Peer keeps at most endpoint.streamWindow parts
+    of a stream unacknowledged."""
+    def __init__(self, chunks, size, chunk):
+        self.size = size
+        self.chunk = chunk
+        self.parts = max(1, -(-size // chunk))
+        # number of parts cut so far
+        self.part = 0
+        self.splitMessageNumber = None
+        # the data is compressed already (the parts are not compressed again)
+        self.compressed = False
+        # parts sent, but not acknowledged
+        self.inFlight = 0
+        # a part, which could not be sent yet (congestion control)
+        self.pending = None
+        # channel of the message (see Channel), it is sent with the first part
+        self.channelID = None
+        self.channelSequence = 0
+        # priority of the parts (see Scheduler)
+        self.priority = NORMAL
+        self._sent = 0
+        self._fragments = self._cut(chunks)
+    
+    @classmethod
+    def fromSource(cls, head, source, size, tail, chunk):
+        """Streams head, size bytes of source and tail.
+        source is bytes-like, a file-like object (read) or an iterable of bytes-like chunks"""
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            body = (source,)
+        elif hasattr(source, 'read'):
+            body = iter(lambda: source.read(65536), b'')
+        else:
+            body = source
+        return cls(itertools.chain((head,), body, (tail,)), len(head) + size + len(tail), chunk)
+    
+    def _cut(self, chunks):
+        chunk = self.chunk
+        pending = None
+        for data in chunks:
+            view = memoryview(data).cast('B')
+            n = len(view)
+            i = 0
+            if pending is not None:
+                i = chunk - len(pending)
+                pending += view[:i]
+                if len(pending) < chunk:
+                    continue
+                yield pending
+                pending = None
+            while n - i >= chunk:
+                yield view[i:i+chunk]
+                i += chunk
+            if i < n:
+                pending = bytearray(view[i:])
+        if pending:
+            yield pending
+    
+    def next(self):
+        """Returns the data of the next part (only valid until the next call),
+        None if all parts are cut. Raises ValueError if the source does not match size"""
+        if self.part == self.parts:
+            return None
+        data = next(self._fragments, None)
+        if data is None or (self.part < self.parts - 1 and len(data) < self.chunk):
+            raise ValueError('source ended after {} of {} bytes'.format(
+                self._sent + len(data or b''), self.size))
+        self._sent += len(data)
+        if self._sent > self.size:
+            raise ValueError('source is longer than {} bytes'.format(self.size))
+        self.part += 1
+        if self.part == self.parts and self._sent != self.size:
+            raise ValueError('source ended after {} of {} bytes'.format(self._sent, self.size))
+        return data
+    
+    def setChannel(self, channelID, sequence):
+        self.channelID = channelID
+        self.channelSequence = sequence
+    
+    @property
+    def done(self):
+        return self.part == self.parts and self.pending is None
+    
+    def __repr__(self):
+        return '<OutgoingStream number={} part={}/{} inFlight={}>'.format(
+            self.splitMessageNumber, self.part, self.parts, self.inFlight)
@@ -0,0 +1,34 @@
+class RTTEstimator(object):
+    """Estimates the retransmission timeout (rto) of a peer from round trip time samples,
+    using a smoothed round trip time and its variance (as TCP does, RFC 6298).
+    Add samples with +="""
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    
+    def __init__(self, initialRTO=0.2, minRTO=0.05, maxRTO=10):
+        if not 0 < minRTO <= maxRTO:
+            raise ValueError('0 < minRTO <= maxRTO required')
+        self.minRTO = minRTO
+        self.maxRTO = maxRTO
+        self.srtt = None
+        self.rttvar = None
+        self.rto = min(max(initialRTO, minRTO), maxRTO)
+    
+    def __iadd__(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(max(self.srtt + self.K * self.rttvar, self.minRTO), self.maxRTO)
+        return self
+    
+    def backoff(self, attempts):
+        """Returns the timeout after the attempts-th transmission of a message
+        (doubled for every retransmission)"""
+        return min(self.rto * (1 << min(attempts - 1, 16)), self.maxRTO)
+    
+    def __repr__(self):
+        return '<RTTEstimator srtt={} rttvar={} rto={}>'.format(self.srtt, self.rttvar, self.rto)
@@ -0,0 +1,190 @@
+import logging
+logger = logging.getLogger(__name__)
+
+class SplitMessage(object):
+    """A message received in parts (TMessageStart, TMessagePart), which are written
+    into one buffer preallocated from the number of parts and the size of the first part.
+    Parts, which arrive before the TMessageStart, are kept until it arrives."""
+    def __init__(self, t):
+        self.parts = None
+        self.chunk = 0
+        self.buffer = None
+        self.received = None
+        self.count = 0
+        # end of the data in buffer (the last part may be shorter)
+        self.length = 0
+        # bytes of memory held
+        self.size = 0
+        self.lastUpdate = t
+        self.dropped = False
+        self._early = {}
+    
+    def allocate(self, parts, chunk):
+        self.parts = parts
+        self.chunk = chunk
+        self.buffer = bytearray(parts * chunk)
+        self.received = bytearray((parts + 7) // 8)
+        self.size = len(self.buffer)
+        early = self._early
+        self._early = None
+        for part, data in early.items():
+            if not self.write(part, data):
+                return False
+        return True
+    
+    def write(self, part, data):
+        """Writes data of part into the buffer, returns False if it does not fit"""
+        if not 0 <= part < self.parts:
+            return False
+        n = len(data)
+        if n > self.chunk or (n < self.chunk and part != self.parts - 1):
+            return False
+        byte = part >> 3
+        bit = 1 << (part & 7)
+        if self.received[byte] & bit:
+            return True
+        self.received[byte] |= bit
+        offset = part * self.chunk
+        self.buffer[offset:offset+n] = data
+        self.count += 1
+        self.length = max(self.length, offset + n)
+        return True
+    
+    @property
+    def complete(self):
+        return self.parts is not None and self.count == self.parts
+    
+    @property
+    def data(self):
+        return memoryview(self.buffer)[:self.length]
+    
+    def __repr__(self):
+        return '<SplitMessage parts={} received={} size={}>'.format(self.parts, self.count, self.size)
+
+class Reassembler(object):
+    """Reassembles the split messages of a peer.
+    The memory held is limited per peer (endpoint.maxPeerReassemblyBytes) and for
+    all peers of the endpoint (endpoint.maxReassemblyBytes), split messages which
+    would exceed it are dropped. Split messages, which did not progress for
+    endpoint.reassemblyTimeout seconds, are evicted.
+    onLost(number) is called for every split message, which is dropped or evicted."""
+    def __init__(self, endpoint, onLost=None):
+        self.endpoint = endpoint
+        self.onLost = onLost
+        self.messages = {}
+        # bytes held by this peer
+        self.size = 0
+        self.dropped = 0
+        self.evicted = 0
+    
+    def start(self, number, parts, data, t):
+        """Adds the first part, which tells the number of parts
+        Returns the data of the message (a memoryview), when it is complete"""
+        with self.endpoint._reassemblyLock:
+            msg = self._get(number, t)
+            if msg is None or msg.parts is not None:
+                return None
+            early = msg.size
+            size = parts * len(data)
+            if parts < 1 or not self._reserve(size - early):
+                logger.warning('Dropping split message %s (%s parts, %s bytes)', number, parts, size)
+                self._drop(number, msg)
+                return None
+            msg.size = 0
+            if not msg.allocate(parts, len(data)) or not msg.write(0, data):
+                logger.warning('Dropping malformed split message %s', number)
+                self._drop(number, msg)
+                return None
+            return self._check(number, msg)
+    
+    def add(self, number, part, data, t):
+        """Adds a further part
+        Returns the data of the message (a memoryview), when it is complete"""
+        with self.endpoint._reassemblyLock:
+            msg = self._get(number, t)
+            if msg is None:
+                return None
+            if msg.parts is None:
+                if part < 1 or part in msg._early:
+                    return None
+                if not self._reserve(len(data)):
+                    logger.warning('Dropping split message %s, reassembly memory exceeded', number)
+                    self._drop(number, msg)
+                    return None
+                # data may be a view into the receive buffer
+                msg._early[part] = bytes(data)
+                msg.size += len(data)
+                return None
+            if part < 1 or not msg.write(part, data):
+                logger.warning('Dropping malformed split message %s', number)
+                self._drop(number, msg)
+                return None
+            return self._check(number, msg)
+    
+    def _get(self, number, t):
+        msg = self.messages.get(number)
+        if msg is None:
+            msg = self.messages[number] = SplitMessage(t)
+        elif msg.dropped:
+            return None
+        msg.lastUpdate = t
+        return msg
+    
+    def _check(self, number, msg):
+        if not msg.complete:
+            return None
+        del self.messages[number]
+        self._release(msg.size)
+        return msg.data
+    
+    def _reserve(self, size):
+        endpoint = self.endpoint
+        if (self.size + size > endpoint.maxPeerReassemblyBytes
+                or endpoint.reassemblyBytes + size > endpoint.maxReassemblyBytes):
+            return False
+        self.size += size
+        endpoint.reassemblyBytes += size
+        return True
+    
+    def _release(self, size):
+        self.size -= size
+        self.endpoint.reassemblyBytes -= size
+    
+    def _drop(self, number, msg):
+        """Frees the memory of msg, further parts of it are ignored until it is evicted"""
+        self._release(msg.size)
+        msg.size = 0
+        msg.buffer = msg.received = msg._early = None
+        msg.dropped = True
+        self.dropped += 1
+        if self.onLost:
+            self.onLost(number)
+    
+    def evict(self, t):
+        """Removes the split messages, which did not progress for reassemblyTimeout seconds"""
+        if not self.messages:
+            return
+        evicted = []
+        with self.endpoint._reassemblyLock:
+            deadline = t - self.endpoint.reassemblyTimeout
+            for number, msg in list(self.messages.items()):
+                if msg.lastUpdate < deadline:
+                    if not msg.dropped:
+                        logger.warning('Evicting incomplete split message %s (%s/%s parts)', number, msg.count, msg.parts)
+                        self.evicted += 1
+                    self._release(msg.size)
+                    del self.messages[number]
+                    evicted.append(number)
+        if self.onLost:
+            # a dropped message may have got its place in a channel after it was dropped
+            for number in evicted:
+                self.onLost(number)
+    
+    def clear(self):
+        with self.endpoint._reassemblyLock:
+            for msg in self.messages.values():
+                self._release(msg.size)
+            self.messages.clear()
+    
+    def __repr__(self):
+        return '<Reassembler messages={} size={}>'.format(len(self.messages), self.size)
@@ -0,0 +1,68 @@
+from collections import deque
+
+# priorities of messages (Message.msgPriority), the ones with a lower number are sent first
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITIES = 3
+
+class Scheduler(object):
+    """The new messages of a peer, which are not sent yet, in one queue per priority.
+    Unreliable messages, which are not sent before their deadline, are dropped,
+    as well as the ones replaced by a newer message with the same coalesceKey."""
+    def __init__(self):
+        self.queues = [deque() for priority in range(PRIORITIES)]
+        # coalesceKey: the newest message queued with it
+        self._latest = {}
+        # statistics by priority
+        self.sent = [0] * PRIORITIES
+        self.expired = [0] * PRIORITIES
+        self.coalesced = [0] * PRIORITIES
+    
+    def put(self, tmsg):
+        if tmsg.coalesceKey is not None:
+            # an older message with the key is skipped by next
+            self._latest[tmsg.coalesceKey] = tmsg
+        self.queues[tmsg.priority].append(tmsg)
+    
+    def putBack(self, tmsg):
+        """Returns a message taken with next, which could not be sent yet"""
+        if tmsg.coalesceKey is not None:
+            self._latest.setdefault(tmsg.coalesceKey, tmsg)
+        self.queues[tmsg.priority].appendleft(tmsg)
+    
+    def next(self, priority, t):
+        """Returns the next message of priority, None if there is none"""
+        queue = self.queues[priority]
+        while queue:
+            tmsg = queue.popleft()
+            key = tmsg.coalesceKey
+            if key is not None:
+                if self._latest.get(key) is not tmsg:
+                    self.coalesced[priority] += 1
+                    continue
+                del self._latest[key]
+            if tmsg.deadline is not None and tmsg.deadline < t and not tmsg.reliable:
+                self.expired[priority] += 1
+                continue
+            return tmsg
+        return None
+    
+    def first(self):
+        """Returns the message, which is sent next, without taking it"""
+        for queue in self.queues:
+            if queue:
+                return queue[0]
+        return None
+    
+    @property
+    def depths(self):
+        """Number of messages waiting by priority"""
+        return [len(queue) for queue in self.queues]
+    
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues)
+    
+    def __repr__(self):
+        return '<Scheduler depths={} sent={} expired={} coalesced={}>'.format(
+            self.depths, self.sent, self.expired, self.coalesced)
@@ -0,0 +1,65 @@
+class SequenceWindow(object):
+    """Remembers which of the last size sequence numbers were seen.
+    It is a bitmap indexed by sequenceNumber % size, which moves forward
+    with the highest sequence number seen. Sequence numbers older than the
+    window can not be told apart from duplicates, so they are rejected."""
+    def __init__(self, size=65536):
+        if size <= 0 or size % 8:
+            raise ValueError('size must be a positive multiple of 8')
+        self.size = int(size)
+        self.highest = 0
+        self.bits = bytearray(self.size // 8)
+    
+    def __contains__(self, sequenceNumber):
+        if sequenceNumber > self.highest:
+            return False
+        if sequenceNumber <= self.highest - self.size:
+            return True
+        i = sequenceNumber % self.size
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+    
+    def add(self, sequenceNumber):
+        """Marks sequenceNumber as seen
+        Returns False, if it was seen before or is older than the window"""
+        if sequenceNumber > self.highest:
+            # forget the numbers, which drop out of the window
+            self._clear(self.highest + 1, sequenceNumber + 1)
+            self.highest = sequenceNumber
+        elif sequenceNumber <= self.highest - self.size:
+            return False
+        i = sequenceNumber % self.size
+        byte = i >> 3
+        bit = 1 << (i & 7)
+        if self.bits[byte] & bit:
+            return False
+        self.bits[byte] |= bit
+        return True
+    
+    def _unset(self, sequenceNumber):
+        i = sequenceNumber % self.size
+        self.bits[i >> 3] &= ~(1 << (i & 7)) & 0xff
+    
+    def _clear(self, start, stop):
+        """Unsets the bits of the numbers start...stop-1"""
+        if stop - start >= self.size:
+            self.bits[:] = bytes(len(self.bits))
+            return
+        # single bits at the edges, then whole bytes
+        while start < stop and start & 7:
+            self._unset(start)
+            start += 1
+        while start < stop and stop & 7:
+            stop -= 1
+            self._unset(stop)
+        if start < stop:
+            a = (start % self.size) >> 3
+            b = a + ((stop - start) >> 3)
+            n = len(self.bits)
+            if b <= n:
+                self.bits[a:b] = bytes(b - a)
+            else:
+                self.bits[a:] = bytes(n - a)
+                self.bits[:b - n] = bytes(b - n)
+    
+    def __repr__(self):
+        return '<SequenceWindow size={} highest={}>'.format(self.size, self.highest)
@@ -0,0 +1,160 @@
+import os
+import socket
+import multiprocessing
+from threading import Thread
+from collections import deque
+from time import time
+from transmitter.general import Server
+
+import logging
+logger = logging.getLogger(__name__)
+
+# statistics every worker reports, summed up by ShardedServer.stats
+STATS = ('peers', 'bytesIn', 'bytesOut', 'packetsIn', 'packetsOut', 'messagesIn', 'messagesOut')
+
+class Shard(object):
+    """The link of a worker's Server to the other workers, available as server.shard"""
+    def __init__(self, index, server, inboxes, stats):
+        self.index = index
+        self.server = server
+        self.running = True
+        self._inboxes = inboxes
+        self._stats = stats
+        # commands received by the inbox thread, handled by update
+        self._commands = deque()
+        self._thread = Thread(target=self._receive)
+        self._thread.daemon = True
+    
+    def start(self):
+        self._thread.start()
+    
+    def broadcast(self, msg, **flags):
+        """Sends msg to the peers of all workers"""
+        self.server.send(msg, **flags)
+        command = ('send', msg._bytes, flags)
+        for i, inbox in enumerate(self._inboxes):
+            if i != self.index:
+                inbox.put(command)
+    
+    def _receive(self):
+        inbox = self._inboxes[self.index]
+        while True:
+            command = inbox.get()
+            self._commands.append(command)
+            # wake up the update loop of the worker
+            self.server._wakeUp()
+            if command[0] == 'stop':
+                break
+    
+    def update(self):
+        """Handles commands from other processes and publishes the statistics"""
+        while True:
+            try:
+                command = self._commands.popleft()
+            except IndexError:
+                break
+            if command[0] == 'send':
+                _, data, flags = command
+                self.server.send(self.server.messageFactory.fromBytes(data), **flags)
+            elif command[0] == 'stop':
+                self.running = False
+        offset = self.index * len(STATS)
+        self._stats[offset] = len(self.server.peers)
+        for i, name in enumerate(STATS[1:], 1):
+            self._stats[offset + i] = getattr(self.server, name).total
+    
+    def __repr__(self):
+        return '<Shard index={}>'.format(self.index)
+
+def _runWorker(index, addr, setup, inboxes, stats, timeout):
+    server = Server()
+    server.reusePort = True
+    server.shard = Shard(index, server, inboxes, stats)
+    setup(server)
+    server.bind(addr)
+    server.start()
+    server.shard.start()
+    logger.info('Worker %s listening on %s', index, addr)
+    while server.shard.running:
+        server.update(timeout=timeout)
+        server.shard.update()
+    server.disconnect()
+    # give the peers time to acknowledge the disconnect
+    deadline = time() + server.timeout
+    while server.peers and time() < deadline:
+        server.update(timeout=timeout)
+    server._close()
+
+class ShardedServer(object):
+    """Runs a Server in each of workers processes, which all bind addr with SO_REUSEPORT.
+    The kernel distributes the clients by their address, so a client keeps talking
+    to the same worker, as long as no worker dies (see supervise). setup(server) is called in every worker before it binds,
+    to add the messages to the factory and attach the events; with the spawn start
+    method it has to be a module level function.
+    In the workers server.shard.broadcast sends a message to the peers of all workers."""
+    def __init__(self, addr, setup, workers=None, timeout=1):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('SO_REUSEPORT is not supported on this platform')
+        self.addr = addr
+        self.setup = setup
+        self.workers = workers or os.cpu_count()
+        # max time a worker blocks in update
+        self.timeout = timeout
+        self.running = False
+        self._context = multiprocessing.get_context()
+        self._inboxes = [self._context.Queue() for i in range(self.workers)]
+        self._stats = self._context.Array('d', self.workers * len(STATS), lock=False)
+        self._processes = [None] * self.workers
+    
+    def start(self):
+        self.running = True
+        for index in range(self.workers):
+            self._startWorker(index)
+    
+    def _startWorker(self, index):
+        process = self._context.Process(target=_runWorker, name='transmitter-worker-{}'.format(index),
+            args=(index, self.addr, self.setup, self._inboxes, self._stats, self.timeout))
+        process.daemon = True
+        process.start()
+        self._processes[index] = process
+    
+    def supervise(self):
+        """Restarts the workers, which died. Call regularly
+        The peers of a died worker time out, its clients have to connect again.
+        The kernel spreads the client addresses over the workers bound at the moment,
+        so when a worker dies and when it is restarted, clients of the other workers
+        can be moved to a worker, which doesn't know them, and have to connect again too"""
+        if not self.running:
+            return
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                logger.error('Worker %s died (exitcode %s) - restarting it', index, process.exitcode)
+                self._startWorker(index)
+    
+    def broadcast(self, msg, **flags):
+        """Sends msg to the peers of all workers"""
+        command = ('send', msg._bytes, flags)
+        for inbox in self._inboxes:
+            inbox.put(command)
+    
+    def stop(self, timeout=None):
+        """Disconnects all peers and waits for the workers to exit
+        Workers wait at most server.timeout for their peers to acknowledge the disconnect,
+        after timeout seconds they are terminated"""
+        self.running = False
+        for inbox in self._inboxes:
+            inbox.put(('stop',))
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+    
+    @property
+    def stats(self):
+        """Sums of the statistics (peers and Measurement totals) of all workers"""
+        n = len(STATS)
+        return {name: sum(self._stats[index * n + i] for index in range(self.workers))
+            for i, name in enumerate(STATS)}
+    
+    def __repr__(self):
+        return '<ShardedServer {} workers={}>'.format(self.addr, self.workers)
@@ -1,7 +1,14 @@
 from transmitter.Endpoint import Endpoint
+from transmitter.AsyncEndpoint import AsyncEndpoint
 
 class Server(Endpoint):
     isServer = True
 
 class Client(Endpoint):
     isClient = True
+
+class AsyncServer(AsyncEndpoint):
+    isServer = True
+
+class AsyncClient(AsyncEndpoint):
+    isClient = True
\ No newline at end of file